@@ -0,0 +1,278 @@
+""" Benchmarks for the hot paths of scanning, tagging and previewing. Runs
+without CEF or a display.
+
+    # Generate a corpus of 500 12 MP images, 30% of them already tagged, and
+    # save the results as a baseline
+    python3 bench.py --count 500 --resolution 4000x3000 --gps-pct 30 --out baseline.json
+
+    # Later, compare against it. Exits with 1 if anything got slower.
+    python3 bench.py --count 500 --resolution 4000x3000 --gps-pct 30 --baseline baseline.json
+"""
+
+from img_exif import get_exif_position, set_exif_position
+from img_manager import ImgManager
+from position_cache import PositionCache
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import wx
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+PREVIEW_SIZE = (120, 67)
+# Size of the thumbnail embedded in the EXIF block, as most cameras write it
+EXIF_THUMBNAIL_SIZE = (160, 120)
+# Describes a generated corpus, so that it's only reused for the same settings
+CORPUS_MANIFEST = 'corpus.json'
+CORPUS_VERSION = 2
+
+
+def make_jpeg(path, size):
+    """ Writes a JPEG of size with enough detail to compress like a photo """
+    w, h = size
+    if PILImage is not None:
+        img = PILImage.effect_noise((w, h), 48).convert('RGB')
+        img.save(path, 'JPEG', quality=90)
+        return
+    img = wx.Image(w, h)
+    img.SetData(os.urandom(w * h * 3))
+    img.SetOption(wx.IMAGE_OPTION_QUALITY, 90)
+    img.SaveFile(path, wx.BITMAP_TYPE_JPEG)
+
+
+def _tiff_ifd(entries, offset, next_ifd):
+    """ Returns a little endian IFD at offset with entries (tag, type, count,
+    value bytes), followed by the values that don't fit in an entry """
+    head = struct.pack('<H', len(entries))
+    extra = b''
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    for tag, typ, count, value in entries:
+        if len(value) <= 4:
+            head += struct.pack('<HHI', tag, typ, count) + value.ljust(4, b'\x00')
+        else:
+            head += struct.pack('<HHII', tag, typ, count, extra_offset + len(extra))
+            extra += value
+    return head + struct.pack('<I', next_ifd) + extra
+
+
+def exif_app1(thumbnail, datetime_original):
+    """ Returns an EXIF APP1 segment like a camera's: a DateTimeOriginal in
+    the Exif IFD, and thumbnail (a JPEG) in IFD1 """
+    taken = datetime_original.encode('ascii') + b'\x00'
+    ifd0_at = 8
+    exif_at = ifd0_at + 2 + 12 + 4
+    ifd1_at = exif_at + 2 + 12 + 4 + len(taken)
+    thumb_at = ifd1_at + 2 + 2 * 12 + 4
+    tiff = (b'II*\x00' + struct.pack('<I', ifd0_at) +
+            _tiff_ifd([(0x8769, 4, 1, struct.pack('<I', exif_at))], ifd0_at, ifd1_at) +
+            _tiff_ifd([(0x9003, 2, len(taken), taken)], exif_at, 0) +
+            _tiff_ifd([(0x0201, 4, 1, struct.pack('<I', thumb_at)),
+                       (0x0202, 4, 1, struct.pack('<I', len(thumbnail)))], ifd1_at, 0) +
+            thumbnail)
+    payload = b'Exif\x00\x00' + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def add_exif(path, thumbnail, datetime_original):
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        # Right after SOI, where cameras put it
+        f.write(data[:2] + exif_app1(thumbnail, datetime_original) + data[2:])
+
+
+def make_corpus(path, count, size, gps_pct, seed=0):
+    """ Creates count images in path. Only one image is encoded, the rest are
+    copies: the content doesn't matter, the number and size of files does.
+    Every image has an EXIF block with a capture time and a thumbnail. """
+    rnd = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    template = os.path.join(path, '.template.jpg')
+    make_jpeg(template, EXIF_THUMBNAIL_SIZE)
+    with open(template, 'rb') as f:
+        thumbnail = f.read()
+    make_jpeg(template, size)
+    add_exif(template, thumbnail, '2019:07:14 12:00:00')
+    for i in range(count):
+        fp = os.path.join(path, f"IMG_{i:06d}.JPG")
+        shutil.copyfile(template, fp)
+        if rnd.random() * 100 < gps_pct:
+            set_exif_position(fp, (rnd.uniform(-80, 80), rnd.uniform(-179, 179)))
+    os.remove(template)
+
+    manifest = {'version': CORPUS_VERSION, 'count': count, 'resolution': f"{size[0]}x{size[1]}",
+                'gps_pct': gps_pct, 'seed': seed}
+    with open(os.path.join(path, CORPUS_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def read_corpus_manifest(path):
+    try:
+        with open(os.path.join(path, CORPUS_MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(corpus, repeat, workers):
+    files = sorted(os.path.join(corpus, f) for f in os.listdir(corpus) if f.endswith('.JPG'))
+    fnames = [os.path.basename(f) for f in files]
+    results = {}
+
+    def record(name, times, n_items):
+        results[name] = {
+            'n_items': n_items,
+            'min_s': min(times),
+            'median_s': statistics.median(times),
+            'per_item_ms': 1000 * statistics.median(times) / max(1, n_items),
+        }
+        print(f"{name:32} {results[name]['median_s']:9.4f}s  {results[name]['per_item_ms']:8.3f} ms/item")
+
+    # Everything imported before the window can be painted. Needs a fresh
+    # interpreter every time, imports are cached after the first one.
+    record('startup_imports', timeit(lambda: subprocess.run([sys.executable, '-c', 'import main'], check=True),
+                                     repeat), 1)
+
+    mgr = ImgManager(PREVIEW_SIZE, placeholder_path=None)
+    record('reload_serial', timeit(lambda: mgr.reload(corpus), repeat), len(files))
+
+    par = ImgManager(PREVIEW_SIZE, scan_workers=workers, placeholder_path=None)
+    def reload_parallel():
+        par.reload(corpus)
+        par.bg.join()
+    record('reload_parallel', timeit(reload_parallel, repeat), len(files))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = PositionCache(os.path.join(tmp, 'positions.sqlite'))
+        cached = ImgManager(PREVIEW_SIZE, position_cache=cache, placeholder_path=None)
+        cached.reload(corpus)
+        record('reload_position_cache_warm', timeit(lambda: cached.reload(corpus), repeat), len(files))
+        cache.close()
+
+    record('get_exif_position', timeit(lambda: [get_exif_position(f) for f in files], repeat), len(files))
+
+    mgr.reload(corpus)
+    record('get_description_for_all', timeit(lambda: mgr.get_description_for(fnames), repeat), len(fnames))
+
+    preview_files = files[:min(len(files), 50)]
+    record('build_preview_image', timeit(lambda: [mgr.build_preview_image(f) for f in preview_files], repeat),
+           len(preview_files))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        copies = []
+        for f in files[:min(len(files), 100)]:
+            copies.append(os.path.join(tmp, os.path.basename(f)))
+            shutil.copyfile(f, copies[-1])
+        record('set_exif_position', timeit(lambda: [set_exif_position(f, (52.37, 4.89)) for f in copies], repeat),
+               len(copies))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Prints how results changed vs baseline. Returns the names of the
+    benchmarks that got slower by more than threshold (a fraction). """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = res['median_s'] / base['median_s'] if base['median_s'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:32} {ratio:6.2f}x vs baseline{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark IMGeotagger hot paths")
+    parser.add_argument('--count', type=int, default=200, help="Number of images in the corpus")
+    parser.add_argument('--resolution', default='4000x3000', help="WxH of corpus images")
+    parser.add_argument('--gps-pct', type=float, default=50, help="Percentage of images with a position")
+    parser.add_argument('--corpus', help="Keep the corpus in this directory, and reuse it if it exists")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Workers for parallel benchmarks")
+    parser.add_argument('--out', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against results saved with --out")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Slowdown (fraction) reported as a regression")
+    args = parser.parse_args(argv)
+
+    # ImgManager expects to run from the app directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    size = tuple(int(v) for v in args.resolution.lower().split('x'))
+
+    tmp = None
+    corpus = args.corpus
+    if corpus is None:
+        tmp = tempfile.TemporaryDirectory()
+        corpus = tmp.name
+    if not os.path.isdir(corpus) or len(os.listdir(corpus)) == 0:
+        print(f"Generating {args.count} images of {size[0]}x{size[1]} in {corpus}")
+        manifest = make_corpus(corpus, args.count, size, args.gps_pct)
+    else:
+        # Results of a different corpus can't be compared, don't reuse one silently
+        manifest = read_corpus_manifest(corpus)
+        wanted = {'version': CORPUS_VERSION, 'count': args.count, 'resolution': f"{size[0]}x{size[1]}",
+                  'gps_pct': args.gps_pct}
+        if manifest is None or any(manifest.get(k) != v for k, v in wanted.items()):
+            parser.error(f"{corpus} isn't a corpus generated with these settings (found {manifest}, "
+                         f"expected {wanted}). Use an empty or new directory.")
+
+    try:
+        results = run_benchmarks(corpus, args.repeat, args.workers)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    report = {
+        'meta': {
+            'count': manifest['count'],
+            'resolution': manifest['resolution'],
+            'gps_pct': manifest['gps_pct'],
+            'repeat': args.repeat,
+            'workers': args.workers,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pillow': PILImage is not None,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+""" Notifies about images added, removed or modified in a directory. Uses
+inotify on Linux to know when to look, and falls back to polling elsewhere.
+Either way, what changed is found by comparing the size and mtime of every
+image against the previous listing: only a stat per file, no file reads.
+Sidecars and RAW companions are reported as a change of their image, since
+they change its position and the files shown with it. """
+
+from img_scan import ALLOWED_EXTENSIONS, scan
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import threading
+
+
+class DirChanges:
+    __slots__ = ('added', 'removed', 'modified')
+
+    def __init__(self, added, removed, modified):
+        # Lists of ScanEntry for added and modified, and of paths for removed
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+
+class _Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(_Inotify.IN_NONBLOCK | _Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Written to by wake(), so that stopping doesn't wait for a select timeout
+        self._wake_r, self._wake_w = os.pipe()
+        self.watched = set()
+
+    def watch(self, path):
+        if path in self.watched:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _Inotify.MASK)
+        if wd < 0:
+            print(f"Can't watch {path}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.watched.add(path)
+
+    def wait(self, timeout):
+        """ Returns True if anything happened within timeout seconds. Returns
+        False right away after wake(). """
+        ready, _, _ = select.select([self.fd, self._wake_r], [], [], timeout)
+        if not ready or self._wake_r in ready:
+            return False
+        try:
+            # Contents don't matter, the caller rescans to find what changed
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def wake(self):
+        os.write(self._wake_w, b'x')
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class DirWatcher:
+    # Wait for this long without events before rescanning, so that a file
+    # being copied is reported once it's complete and not on every write
+    SETTLE_SECS = 0.5
+
+    def __init__(self, root, on_changes, recursive=False, extensions=ALLOWED_EXTENSIONS,
+                 exclude=(), poll_interval=2.0, use_inotify=True):
+        """ on_changes(DirChanges) is called from the watcher thread """
+        self.root = root
+        self.on_changes = on_changes
+        self.recursive = recursive
+        self.extensions = extensions
+        self.exclude = exclude
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._inotify = None
+        if use_inotify and sys.platform.startswith('linux'):
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as ex:
+                print(f"inotify not available, polling {root} for changes instead: {ex}")
+        self._snapshot = self._take_snapshot()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for entry in scan(self.root, self.recursive, self.extensions, self.exclude):
+            snapshot[entry.path] = entry
+        if self._inotify is not None:
+            self._inotify.watch(self.root)
+            if self.recursive:
+                for dirpath in set(os.path.dirname(p) for p in snapshot):
+                    self._inotify.watch(dirpath)
+                # Empty dirs have no images, but new ones may be copied there
+                for dirpath, _, _ in os.walk(self.root):
+                    self._inotify.watch(dirpath)
+        return snapshot
+
+
+    @staticmethod
+    def _changed(old, new):
+        return (old.size != new.size or old.mtime_ns != new.mtime_ns or
+                old.sidecar_mtime_ns != new.sidecar_mtime_ns or old.companions != new.companions)
+
+
+    def _diff(self):
+        old = self._snapshot
+        new = self._take_snapshot()
+        added = [e for p, e in new.items() if p not in old]
+        removed = [p for p in old if p not in new]
+        modified = [e for p, e in new.items() if p in old and DirWatcher._changed(old[p], e)]
+        self._snapshot = new
+        return DirChanges(added, removed, modified)
+
+
+    def _wait_for_events(self):
+        if self._inotify is None:
+            return not self._stop.wait(self.poll_interval)
+
+        while not self._stop.is_set():
+            if self._inotify.wait(self.poll_interval):
+                break
+        # Let a burst of events settle
+        while not self._stop.is_set() and self._inotify.wait(DirWatcher.SETTLE_SECS):
+            pass
+        return not self._stop.is_set()
+
+
+    def _run(self):
+        while self._wait_for_events():
+            try:
+                changes = self._diff()
+            except OSError as ex:
+                print(f"Error checking {self.root} for changes: {ex}")
+                continue
+            if changes:
+                self.on_changes(changes)
+
+
+    def stop(self):
+        self._stop.set()
+        if self._inotify is not None:
+            self._inotify.wake()
+        self._thread.join()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
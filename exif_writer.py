@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from img_exif import set_exif_position
+import sys
+import threading
+import time
+
+
+class ExifWriter:
+    """ Writes GPS positions to files on a pool of workers. Tagging a file
+    that is still waiting to be written only replaces the position to write,
+    so re-tagging the same selection many times costs one write per file.
+
+    on_written(path, pos, ok) is called from a worker thread after each
+    file is processed.
+
+    With delay > 0 a file is only written once it hasn't been tagged for
+    that many seconds, so re-aiming a position a few times in a row only
+    writes the last one.
+
+    write(path, pos) does the actual writing, eg img_exif.set_sidecar_position
+    to write XMP sidecars instead of the files themselves. """
+
+    def __init__(self, workers, on_written=None, delay=0, write=set_exif_position):
+        self.on_written = on_written
+        self.delay = delay
+        self._write = write
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # Wakes the dispatcher when a delayed write is queued
+        self._wake = threading.Condition(self._lock)
+        # path -> position still to be written
+        self._queued = {}
+        # Delayed paths of _queued not handed to the pool yet -> when they are due
+        self._due = {}
+        # paths with a write in progress
+        self._running = set()
+        # Number of on_written calls in progress. wait() also waits for
+        # these, so callers see the effects of every callback.
+        self._callbacks = 0
+        self._dispatcher = None
+        self._closed = False
+        self.written = 0
+        self.failed = 0
+
+
+    def write(self, path, pos):
+        with self._lock:
+            submitted = path in self._queued and path not in self._due
+            self._queued[path] = pos
+            if submitted:
+                # Will pick up the new position when it starts
+                return
+            if self.delay > 0:
+                self._due[path] = time.monotonic() + self.delay
+                self._start_dispatcher()
+                self._wake.notify()
+            elif path not in self._running:
+                # If a write for path is in progress it will be resubmitted when it finishes
+                self._pool.submit(self._write_one, path)
+
+
+    def write_many(self, pos, paths):
+        for path in paths:
+            self.write(path, pos)
+
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._queued) + len(self._running)
+
+
+    def is_pending(self, path):
+        with self._lock:
+            return path in self._queued or path in self._running
+
+
+    def flush(self):
+        """ Starts every delayed write now, without waiting for them """
+        with self._lock:
+            for path in list(self._due):
+                self._submit_due(path)
+
+
+    def wait(self, timeout=None):
+        """ Flushes and blocks until every queued write is done. Returns False
+        on timeout """
+        self.flush()
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._queued and not self._running and not self._callbacks,
+                                       timeout)
+
+
+    def wait_below(self, max_pending, timeout=None):
+        """ Blocks until no more than max_pending writes are left. Useful to
+        bound memory when feeding the writer from a very long stream. """
+        with self._lock:
+            return self._idle.wait_for(lambda: len(self._queued) + len(self._running) <= max_pending,
+                                       timeout)
+
+
+    def shutdown(self):
+        self.wait()
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._pool.shutdown()
+
+
+    def _start_dispatcher(self):
+        # Caller must hold the lock
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self._dispatcher.start()
+
+
+    def _dispatch(self):
+        """ Hands delayed writes to the pool as they become due """
+        with self._lock:
+            while not self._closed:
+                if not self._due:
+                    self._wake.wait()
+                    continue
+                now = time.monotonic()
+                next_due = min(self._due.values())
+                if next_due > now:
+                    self._wake.wait(next_due - now)
+                    continue
+                for path in [p for p, due in self._due.items() if due <= now]:
+                    self._submit_due(path)
+
+
+    def _submit_due(self, path):
+        # Caller must hold the lock
+        del self._due[path]
+        # A write still running for path resubmits it when it finishes
+        if path not in self._running:
+            self._pool.submit(self._write_one, path)
+
+
+    def _write_one(self, path):
+        with self._lock:
+            pos = self._queued.pop(path)
+            self._running.add(path)
+
+        try:
+            ok = self._write(path, pos)
+        except:
+            print(f"Error writing position for {path}", sys.exc_info()[0])
+            ok = False
+
+        with self._lock:
+            self._running.discard(path)
+            if ok:
+                self.written += 1
+            else:
+                self.failed += 1
+            if path in self._queued and path not in self._due:
+                # Re-tagged while this write was running
+                self._pool.submit(self._write_one, path)
+            if self.on_written is not None:
+                self._callbacks += 1
+            self._idle.notify_all()
+
+        if self.on_written is None:
+            return
+        try:
+            self.on_written(path, pos, ok)
+        finally:
+            with self._lock:
+                self._callbacks -= 1
+                self._idle.notify_all()
@@ -0,0 +1,91 @@
+""" Off-thread decoding of the large image preview, at the size it will be
+shown at, with a small cache and prefetching of the images likely to be
+shown next. """
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from img_decode import decode_for_size
+import sys
+import threading
+import wx
+
+
+def fill_size(img_size, target_size):
+    """ Size to scale img_size to so that it covers target_size, keeping its
+    aspect ratio. Never scales up. """
+    iw, ih = img_size
+    tw, th = target_size
+    k = min(1.0, max(tw / iw, th / ih))
+    return (max(1, int(iw * k)), max(1, int(ih * k)))
+
+
+class FullPreviewLoader:
+    def __init__(self, workers=2, cache_size=6):
+        self.cache_size = cache_size
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        # (path, size) -> wx.Image, least recently used first
+        self._cache = OrderedDict()
+        # (path, size) -> list of callbacks waiting for it
+        self._inflight = {}
+
+
+    def request(self, path, size, on_ready):
+        """ Calls on_ready(path, wx.Image) in the UI thread once path has been
+        decoded for size. Runs right away if it's cached. """
+        key = (path, tuple(size))
+        with self._lock:
+            img = self._cache.get(key)
+            if img is not None:
+                self._cache.move_to_end(key)
+            else:
+                self._submit(key, on_ready)
+        if img is not None:
+            on_ready(path, img)
+
+
+    def prefetch(self, paths, size):
+        with self._lock:
+            for path in paths:
+                key = (path, tuple(size))
+                if key not in self._cache:
+                    self._submit(key, None)
+
+
+    def _submit(self, key, on_ready):
+        # Called with the lock held
+        waiting = self._inflight.get(key)
+        if waiting is not None:
+            if on_ready is not None:
+                waiting.append(on_ready)
+            return
+        self._inflight[key] = [on_ready] if on_ready is not None else []
+        self._pool.submit(self._decode, key)
+
+
+    def _decode(self, key):
+        path, size = key
+        try:
+            img = decode_for_size(path, size, allow_thumbnail=False)
+            if img.IsOk():
+                img = img.Scale(*fill_size(img.GetSize().Get(), size), wx.IMAGE_QUALITY_HIGH)
+            else:
+                img = None
+        except:
+            print(f"Error creating preview for {path}", sys.exc_info()[0])
+            img = None
+
+        with self._lock:
+            waiting = self._inflight.pop(key, [])
+            if img is not None:
+                self._cache[key] = img
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        if img is not None:
+            for on_ready in waiting:
+                wx.CallAfter(on_ready, path, img)
+
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
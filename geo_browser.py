@@ -1,9 +1,13 @@
 # This file was stolen and adapted from here
 # https://github.com/cztomczak/cefpython/blob/master/examples/wxpython.py
 
-from cefpython3 import cefpython as cef
+from offline_map import MAP_URL as OFFLINE_MAP_URL, OfflineMapRequestHandler
+import base64
+import instrument
+import os
 import platform
 import sys
+import time
 import wx
 
 # Platforms
@@ -11,7 +15,14 @@ WINDOWS = (platform.system() == "Windows")
 LINUX = (platform.system() == "Linux")
 MAC = (platform.system() == "Darwin")
 
+# cefpython3 module, imported by cef_xplat_init. Loading it takes a good part
+# of the startup time, so it's only done once the window is up.
+cef = None
+
 def cef_xplat_init():
+    global cef
+    with instrument.span('startup.cef_import'):
+        from cefpython3 import cefpython as cef
     assert cef.__version__ >= "66.0", "CEF Python v66.0+ required to run this"
     sys.excepthook = cef.ExceptHook  # To shutdown all CEF processes on error
     settings = {}
@@ -57,19 +68,58 @@ class FocusHandler(object):
             browser.SetFocus(True)
 
 
+class MapEventsHandler(object):
+    """ Reports map movements as soon as CEF sees them, instead of having
+    to poll the browser's URL """
+
+    def __init__(self, geo_browser):
+        self.geo_browser = geo_browser
+
+    def OnAddressChange(self, browser, frame, url, **_):
+        # Google Maps updates the URL (through history.replaceState) when the
+        # map moves, which CEF reports as an address change
+        if frame.IsMain():
+            self.geo_browser.on_url_changed(url)
+
+    def OnLoadingStateChange(self, browser, is_loading, **_):
+        self.geo_browser.note_activity()
+
+    def OnLoadEnd(self, browser, frame, http_code, **_):
+        if frame.IsMain():
+            self.geo_browser.on_page_loaded()
+
+
 class GeoBrowser:
     BROWSER_CREATED = False
+    # Name of the function a map page can call to report its center as (lat, lon)
+    JS_MAP_CENTER_CALLBACK = 'py_map_center'
+
+    # CEF has no work to do most of the time, so in adaptive mode its message
+    # loop is pumped less often after a while without any browser activity
+    PUMP_ACTIVE_MS = 10
+    PUMP_IDLE_MS = 50
+    PUMP_BACKGROUND_MS = 250
+    PUMP_IDLE_AFTER_SECS = 2
+
+    GMAPS_URL = 'https://maps.google.com/'
 
-    def __init__(self, parent_wnd):
+    def __init__(self, parent_wnd, adaptive_pump=True, mbtiles_path=None):
+        """ If mbtiles_path is set, the map is rendered from that MBTiles
+        file instead of Google Maps, and works without network access. """
         if GeoBrowser.BROWSER_CREATED:
             print("Only one browser instance is supported")
             sys.exit(1)
 
         GeoBrowser.BROWSER_CREATED = True
-        cef_xplat_init()
 
         self.parent_wnd = parent_wnd
         self.browser = None
+        self.coords = None
+        self.coords_listener = None
+        self.adaptive_pump = adaptive_pump
+        self.mbtiles_path = mbtiles_path
+        self.last_activity = time.monotonic()
+        self.app_active = True
 
         # Set wx.WANTS_CHARS style for the keyboard to work.
         # This style also needs to be set for all parent controls.
@@ -77,12 +127,20 @@ class GeoBrowser:
         self.panel.Bind(wx.EVT_SET_FOCUS, self.OnSetFocus)
         self.panel.Bind(wx.EVT_SIZE, self.OnSize)
         self.panel.Bind(wx.EVT_CLOSE, self.OnClose)
+        self.loading_lbl = wx.StaticText(self.panel, -1, label="Loading map...")
 
         self.timer_id = 1
         self.timer = wx.Timer(self.panel, self.timer_id)
+        self.parent_wnd.Bind(wx.EVT_ACTIVATE, self.OnActivate)
 
 
     def load_browser(self):
+        """ Starts CEF and loads the map. This is slow, so it can be called
+        after the rest of the window is already shown. """
+        if cef is None:
+            with instrument.span('startup.cef_init'):
+                cef_xplat_init()
+
         if LINUX:
             # On Linux must show before embedding browser, so that handle
             # is available (Issue #347).
@@ -99,36 +157,79 @@ class GeoBrowser:
             self.embed_browser()
             self.parent_wnd.Show()
 
-        self.timer_cnt = 0
         self.panel.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
-        self.timer.Start(10)  # 10ms timer
+        self.timer.Start(GeoBrowser.PUMP_ACTIVE_MS)
 
 
     def embed_browser(self):
+        if self.loading_lbl is not None:
+            self.loading_lbl.Destroy()
+            self.loading_lbl = None
         window_info = cef.WindowInfo()
         (width, height) = self.panel.GetClientSize().Get()
         assert self.panel.GetHandle(), "Window handle not available"
         window_info.SetAsChild(self.panel.GetHandle(),
                                [0, 0, width, height])
-        self.browser = cef.CreateBrowserSync(window_info, url="https://maps.google.com/")
+        url = GeoBrowser.GMAPS_URL if self.mbtiles_path is None else OFFLINE_MAP_URL
+        self.browser = cef.CreateBrowserSync(window_info, url=url)
         self.browser.SetClientHandler(FocusHandler())
+        self.browser.SetClientHandler(MapEventsHandler(self))
+        if self.mbtiles_path is not None:
+            self.browser.SetClientHandler(OfflineMapRequestHandler(self.mbtiles_path))
+
+        bindings = cef.JavascriptBindings(bindToFrames=False, bindToPopups=False)
+        bindings.SetFunction(GeoBrowser.JS_MAP_CENTER_CALLBACK, self.on_js_map_center)
+        self.browser.SetJavascriptBindings(bindings)
 
     
     def on_timer(self, _):
-        cef.MessageLoopWork()
-        self.timer_cnt -= 1
-        if self.timer_cnt <= 0:
-            self.timer_cnt = 1000 / self.timer.Interval # 1 second
+        with instrument.span('cef.pump'):
+            cef.MessageLoopWork()
+        if not self.adaptive_pump:
+            return
+
+        # cefpython doesn't expose CEF's OnScheduleMessagePumpWork, so there's
+        # no way to know when work is due. Use browser activity as a hint.
+        if time.monotonic() - self.last_activity < GeoBrowser.PUMP_IDLE_AFTER_SECS:
+            interval = GeoBrowser.PUMP_ACTIVE_MS
+        elif self.app_active:
+            interval = GeoBrowser.PUMP_IDLE_MS
+        else:
+            interval = GeoBrowser.PUMP_BACKGROUND_MS
+        if interval != self.timer.GetInterval():
+            self.timer.Start(interval)
+
+
+    def note_activity(self):
+        """ Something happened in the browser, pump its message loop at full rate """
+        self.last_activity = time.monotonic()
+        if self.adaptive_pump and self.timer.IsRunning() and \
+                self.timer.GetInterval() != GeoBrowser.PUMP_ACTIVE_MS:
+            self.timer.Start(GeoBrowser.PUMP_ACTIVE_MS)
+
+
+    def on_page_loaded(self):
+        self.note_activity()
+        if self.mbtiles_path is None:
+            # The offline map page already has its own crosshair
             self.apply_hacks()
 
 
+    @staticmethod
+    def crosshair_data_url():
+        """ The bundled crosshair.png, inlined so the page doesn't need to fetch it """
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crosshair.png')
+        with open(path, 'rb') as f:
+            return 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+
+
     def apply_hacks(self):
         """ Show a crosshair in the middle of the page """
         hack = "" + \
                "if (!document.getElementById('hack_crosshair')) {" + \
                "var img = document.createElement('img');" + \
                "img.id = 'hack_crosshair';" + \
-               "img.src = 'https://raw.githubusercontent.com/nicolasbrailo/IMGeotaggerV3/master/crosshair.png';" + \
+               "img.src = '" + GeoBrowser.crosshair_data_url() + "';" + \
                "img.style.position='absolute';" + \
                "img.style.left='50%';" + \
                "img.style.marginLeft='-24px';" + \
@@ -139,10 +240,38 @@ class GeoBrowser:
         self.browser.GetMainFrame().ExecuteJavascript(hack)
 
     
+    def set_coords_listener(self, listener):
+        """ listener(coords) will be called in the UI thread each time the
+        center of the map changes """
+        self.coords_listener = listener
+
+
     def get_coords(self):
-        if self.browser is None:
-            return None
-        return GeoBrowser.hack_coords_from_gmaps(self.browser.GetUrl())
+        return self.coords
+
+
+    def on_url_changed(self, url):
+        self.note_activity()
+        coords = GeoBrowser.hack_coords_from_gmaps(url)
+        if coords is not None:
+            self._set_coords(coords)
+
+
+    def on_js_map_center(self, lat, lon):
+        self.note_activity()
+        try:
+            self._set_coords((float(lat), float(lon)))
+        except (TypeError, ValueError):
+            print("Map page reported invalid coords:", lat, lon)
+
+
+    def _set_coords(self, coords):
+        if coords == self.coords:
+            return
+        self.coords = coords
+        if self.coords_listener is not None:
+            # CEF may call us while pumping its message loop, don't re-enter wx from there
+            wx.CallAfter(self.coords_listener, coords)
 
 
     @staticmethod
@@ -165,9 +294,16 @@ class GeoBrowser:
             return None
 
 
+    def OnActivate(self, event):
+        event.Skip()
+        self.app_active = event.GetActive()
+        self.note_activity()
+
+
     def OnSetFocus(self, _):
         if not self.browser:
             return
+        self.note_activity()
         if WINDOWS:
             cef.WindowUtils.OnSetFocus(self.panel.GetHandle(), 0, 0, 0)
         self.browser.SetFocus(True)
@@ -176,6 +312,7 @@ class GeoBrowser:
     def OnSize(self, _):
         if not self.browser:
             return
+        self.note_activity()
         if WINDOWS:
             cef.WindowUtils.OnSize(self.panel.GetHandle(), 0, 0, 0)
         elif LINUX:
@@ -220,6 +357,9 @@ class GeoBrowser:
 
     @staticmethod
     def static_on_app_exit():
+        if cef is None:
+            # Closed before the map was loaded
+            return
         if not MAC:
             # On Mac shutdown is called in OnClose
             cef.Shutdown()
@@ -0,0 +1,202 @@
+""" Headless batch geotagging. Doesn't need wx, CEF or a display.
+
+Examples:
+    # Tag files listed in a manifest (CSV rows of path,lat,lon)
+    python3 geotag_cli.py --manifest positions.csv
+
+    # JSON manifests map path -> [lat, lon]
+    python3 geotag_cli.py --manifest positions.json
+
+    # Apply one position to every image under a directory tree
+    python3 geotag_cli.py --tree ~/Pictures/2019/07 --coords 52.37,4.89
+
+    # Negative positions need --lat/--lon, or '=' so argparse doesn't take
+    # them for an option
+    python3 geotag_cli.py --tree ~/Pictures/2019/07 --lat -33.86 --lon 151.2
+    python3 geotag_cli.py --tree ~/Pictures/2019/07 --coords=-33.86,151.2
+
+    # Match capture times against GPS logger tracks. The camera clock was
+    # set to UTC+2, so 2 hours have to be subtracted to get UTC.
+    python3 geotag_cli.py --tree ~/Pictures/2019/07 --gpx day1.gpx day2.gpx --camera-offset -7200
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from exif_writer import ExifWriter
+from gpx_track import Track, correlate
+from img_exif import get_exif_datetime, get_exif_position, set_exif_position, set_sidecar_position
+from img_scan import iter_images
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+
+def parse_coords(txt):
+    try:
+        lat, lon = [float(x) for x in txt.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected coords as LAT,LON, got '{txt}'")
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        raise argparse.ArgumentTypeError(f"Coords out of range: '{txt}'")
+    return (lat, lon)
+
+
+def iter_csv_manifest(path, base_dir):
+    """ Yields (path, (lat, lon)) from a CSV with rows of path,lat,lon. A
+    header row is allowed. Rows are streamed, not loaded all at once. """
+    with open(path, newline='') as f:
+        for lineno, row in enumerate(csv.reader(f), start=1):
+            if len(row) == 0 or row[0].startswith('#'):
+                continue
+            try:
+                pos = (float(row[1]), float(row[2]))
+            except (IndexError, ValueError):
+                if lineno == 1:
+                    # Probably a header
+                    continue
+                print(f"{path}:{lineno}: can't parse row, skipping", file=sys.stderr)
+                continue
+            yield os.path.join(base_dir, row[0]), pos
+
+
+def iter_json_manifest(path, base_dir):
+    """ Yields (path, (lat, lon)) from a JSON manifest, either an object of
+    path -> [lat, lon] or a list of {"path": ..., "lat": ..., "lon": ...} """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if isinstance(manifest, dict):
+        entries = ((fp, pos[0], pos[1]) for fp, pos in manifest.items())
+    else:
+        entries = ((e['path'], e['lat'], e['lon']) for e in manifest)
+
+    for fp, lat, lon in entries:
+        yield os.path.join(base_dir, fp), (float(lat), float(lon))
+
+
+def iter_manifest(path, base_dir=None):
+    if base_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith('.json'):
+        return iter_json_manifest(path, base_dir)
+    return iter_csv_manifest(path, base_dir)
+
+
+def iter_tree(root, pos):
+    for fp in iter_images(root):
+        yield fp, pos
+
+
+def iter_gpx(root, gpx_paths, camera_offset, max_gap, workers):
+    """ Yields (path, pos) for every image under root with a capture time
+    covered by the tracks in gpx_paths """
+    track = Track.from_files(gpx_paths)
+    print(f"Loaded {len(track)} track points from {len(gpx_paths)} files")
+
+    paths = list(iter_images(root))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        times = list(pool.map(get_exif_datetime, paths))
+    photos = [(p, t) for p, t in zip(paths, times) if t is not None]
+
+    unmatched = 0
+    for path, pos in correlate(track, photos, camera_offset, max_gap):
+        if pos is None:
+            unmatched += 1
+            continue
+        yield path, pos
+    print(f"{len(paths) - len(photos)} files without capture time, {unmatched} not covered by the track")
+
+
+class Stats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.seen = 0
+        self.skipped = 0
+        self.missing = 0
+
+
+    def report(self, writer, out=sys.stdout):
+        elapsed = time.monotonic() - self.start
+        written = writer.written if writer is not None else 0
+        failed = writer.failed if writer is not None else 0
+        rate = written / elapsed if elapsed > 0 else 0
+        print(f"Files seen: {self.seen}", file=out)
+        print(f"Written: {written}, failed: {failed}, skipped: {self.skipped}, missing: {self.missing}", file=out)
+        print(f"Elapsed: {elapsed:.2f}s, throughput: {rate:.1f} files/s", file=out)
+
+
+def run(jobs, workers, max_pending, skip_tagged, dry_run, sidecar=False):
+    stats = Stats()
+    write = set_sidecar_position if sidecar else set_exif_position
+    writer = None if dry_run else ExifWriter(workers, write=write)
+    for path, pos in jobs:
+        stats.seen += 1
+        if not os.path.isfile(path):
+            print(f"{path} doesn't exist, skipping", file=sys.stderr)
+            stats.missing += 1
+            continue
+        if skip_tagged and get_exif_position(path) is not None:
+            stats.skipped += 1
+            continue
+        if dry_run:
+            print(f"Would set {path} to {pos}")
+            continue
+
+        # Don't let a long stream of jobs pile up in memory
+        writer.wait_below(max_pending)
+        writer.write(path, pos)
+
+    if writer is not None:
+        writer.shutdown()
+    stats.report(writer)
+    return stats, writer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Set GPS EXIF positions of images in batch")
+    src = parser.add_mutually_exclusive_group(required=True)
+    src.add_argument('--manifest', help="CSV (path,lat,lon) or JSON manifest of positions")
+    src.add_argument('--tree', help="Directory tree to tag, requires --coords, --lat/--lon or --gpx")
+    parser.add_argument('--coords', type=parse_coords,
+                        help="LAT,LON to apply to every image in --tree. Write --coords=LAT,LON if LAT is negative.")
+    parser.add_argument('--lat', type=float, help="Latitude to apply to every image in --tree, with --lon")
+    parser.add_argument('--lon', type=float, help="Longitude to apply to every image in --tree, with --lat")
+    parser.add_argument('--gpx', nargs='+', help="GPX tracks to correlate with the images in --tree")
+    parser.add_argument('--camera-offset', type=float, default=0, help="Seconds to add to the camera clock to get UTC")
+    parser.add_argument('--max-gap', type=float, default=300, help="Max seconds between a photo and the closest track points")
+    parser.add_argument('--base-dir', help="Relative manifest paths are relative to this. Defaults to the manifest's directory.")
+    parser.add_argument('--workers', type=int, default=4, help="Number of files written in parallel")
+    parser.add_argument('--max-pending', type=int, default=256, help="Max number of queued writes")
+    parser.add_argument('--sidecar', action='store_true', help="Write XMP sidecars instead of rewriting the images")
+    parser.add_argument('--skip-tagged', action='store_true', help="Don't overwrite files that already have a position")
+    parser.add_argument('--dry-run', action='store_true', help="Only print what would be done")
+    args = parser.parse_args(argv)
+
+    if (args.lat is None) != (args.lon is None):
+        parser.error("--lat and --lon must be given together")
+    if args.lat is not None:
+        if args.coords is not None:
+            parser.error("--coords can't be used with --lat/--lon")
+        try:
+            args.coords = parse_coords(f"{args.lat},{args.lon}")
+        except argparse.ArgumentTypeError as ex:
+            parser.error(str(ex))
+
+    if args.tree is not None:
+        if (args.coords is None) == (args.gpx is None):
+            parser.error("--tree requires one of --coords, --lat/--lon or --gpx")
+        if args.gpx is not None:
+            jobs = iter_gpx(args.tree, args.gpx, args.camera_offset, args.max_gap, args.workers)
+        else:
+            jobs = iter_tree(args.tree, args.coords)
+    else:
+        jobs = iter_manifest(args.manifest, args.base_dir)
+
+    _, writer = run(jobs, args.workers, args.max_pending, args.skip_tagged, args.dry_run, args.sidecar)
+    return 1 if writer is not None and writer.failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+""" Correlation of photos with GPS logger tracks. Positions are resolved by
+matching each photo's capture time against the points of one or more GPX
+files, interpolating linearly between the two closest points. """
+
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timezone
+import xml.etree.ElementTree as ET
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_gpx_time(txt):
+    """ Parses a GPX timestamp (ISO 8601, normally UTC) to epoch seconds """
+    txt = txt.strip()
+    if txt.endswith('Z'):
+        txt = txt[:-1] + '+00:00'
+    # fromisoformat only accepts 3 or 6 digit fractions, and we don't need them
+    if '.' in txt:
+        head, tail = txt.split('.', 1)
+        tz = ''
+        for sep in ('+', '-'):
+            if sep in tail:
+                tz = tail[tail.index(sep):]
+        txt = head + tz
+    t = datetime.fromisoformat(txt)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=timezone.utc)
+    return t.timestamp()
+
+
+def parse_exif_time(txt):
+    """ Parses an EXIF DateTimeOriginal ('YYYY:MM:DD HH:MM:SS') to epoch
+    seconds. EXIF has no timezone, the camera clock is assumed to be UTC and
+    any difference must be given as an offset when correlating. """
+    t = datetime.strptime(txt.strip(), '%Y:%m:%d %H:%M:%S')
+    return t.replace(tzinfo=timezone.utc).timestamp()
+
+
+class Track:
+    """ Points of one or more GPX tracks, as sorted timestamp/lat/lon columns """
+
+    def __init__(self):
+        self.times = array('d')
+        self.lats = array('d')
+        self.lons = array('d')
+
+
+    @staticmethod
+    def from_files(paths):
+        points = []
+        for path in paths:
+            points.extend(Track._read_points(path))
+        points.sort()
+
+        track = Track()
+        for t, lat, lon in points:
+            track.times.append(t)
+            track.lats.append(lat)
+            track.lons.append(lon)
+        return track
+
+
+    @staticmethod
+    def _read_points(path):
+        """ Yields (time, lat, lon) for every timestamped track point in path """
+        for _, elem in ET.iterparse(path):
+            # Waypoints aren't fixes of the logger, their times can be anything
+            if _local_name(elem.tag) not in ('trkpt', 'rtept'):
+                continue
+            time_txt = None
+            for child in elem:
+                if _local_name(child.tag) == 'time':
+                    time_txt = child.text
+            if time_txt is not None:
+                try:
+                    yield parse_gpx_time(time_txt), float(elem.get('lat')), float(elem.get('lon'))
+                except (TypeError, ValueError):
+                    print(f"Skipping invalid point in {path}")
+            # Points are only needed once, don't keep the whole tree in memory
+            elem.clear()
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def _interpolate(self, i, t, max_gap):
+        """ Position at t, given times[i-1] <= t <= times[i] """
+        n = len(self.times)
+        if i < n and self.times[i] == t:
+            return (self.lats[i], self.lons[i])
+        if i == 0:
+            return (self.lats[0], self.lons[0]) if self.times[0] - t <= max_gap else None
+        if i == n:
+            return (self.lats[-1], self.lons[-1]) if t - self.times[-1] <= max_gap else None
+
+        t0, t1 = self.times[i - 1], self.times[i]
+        if t1 - t0 > max_gap:
+            # The logger was off, or lost its fix, between these points. Use
+            # the closest one if it's near enough, like at the track ends.
+            if t - t0 <= t1 - t:
+                return (self.lats[i - 1], self.lons[i - 1]) if t - t0 <= max_gap else None
+            return (self.lats[i], self.lons[i]) if t1 - t <= max_gap else None
+        k = (t - t0) / (t1 - t0)
+        lat = self.lats[i - 1] + k * (self.lats[i] - self.lats[i - 1])
+        lon = self.lons[i - 1] + k * (self.lons[i] - self.lons[i - 1])
+        return (lat, lon)
+
+
+    def locate(self, t, max_gap):
+        """ Returns the (lat, lon) at epoch time t, or None if the track has no
+        points within max_gap seconds around t """
+        if len(self.times) == 0:
+            return None
+        return self._interpolate(bisect_left(self.times, t), t, max_gap)
+
+
+    def locate_many(self, times, max_gap):
+        """ Same as locate() for a batch of times. Sorts the batch once and
+        walks it together with the track, so it's linear in the size of both
+        instead of doing one binary search per time. """
+        result = [None] * len(times)
+        if len(self.times) == 0:
+            return result
+
+        order = sorted(range(len(times)), key=lambda k: times[k])
+        i = 0
+        n = len(self.times)
+        for k in order:
+            t = times[k]
+            while i < n and self.times[i] < t:
+                i += 1
+            result[k] = self._interpolate(i, t, max_gap)
+        return result
+
+
+def correlate(track, photos, camera_offset=0, max_gap=300):
+    """ Resolves the position of every photo in photos, a list of
+    (path, exif_time_str). camera_offset is the number of seconds to add to
+    the camera clock to get UTC. Yields (path, (lat, lon) or None). """
+    paths = []
+    times = []
+    for path, exif_time in photos:
+        try:
+            t = parse_exif_time(exif_time)
+        except (AttributeError, ValueError):
+            print(f"Can't parse capture time of {path}: {exif_time}")
+            continue
+        paths.append(path)
+        times.append(t + camera_offset)
+
+    for path, pos in zip(paths, track.locate_many(times, max_gap)):
+        yield path, pos
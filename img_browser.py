@@ -1,17 +1,54 @@
-import threading
+from collections import OrderedDict
+from preview_loader import PreviewLoader
+import instrument
+import os
 import wx
 
+
+class _VirtualImgList(wx.ListCtrl):
+    """ List control that asks its owner for the contents of each row, so
+    only rows being drawn need to exist """
+
+    def __init__(self, parent, size, owner):
+        super().__init__(parent, style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.BORDER_SUNKEN, size=size)
+        self.owner = owner
+
+    def OnGetItemText(self, item, col):
+        return self.owner._virtual_item_text(item, col)
+
+    def OnGetItemImage(self, item):
+        return self.owner._virtual_item_image(item)
+
+    def OnGetItemAttr(self, item):
+        return self.owner._virtual_item_attr(item)
+
+
 class ImgBrowser:
     CTRL_MARGIN = 5
     BUTTON_WIDTH = 100
     NAME_COL_WIDTH = 180
     COORDS_COL_WIDTH = 30
+    # While listing a directory, repaint the list every this many rows
+    ROWS_PER_REPAINT = 200
+    # In virtual mode, min number of previews kept in the image list. The
+    # actual number grows with the number of rows that fit in the window.
+    VIRTUAL_MIN_PREVIEWS = 64
+    # Photos this close to the map center are highlighted
+    NEARBY_RADIUS_M = 500
+    NEARBY_COLOUR = (255, 240, 180)
+    # Default window, in minutes, to copy a position to shots taken around the same time
+    PROPAGATE_MINUTES = 5
+    PROPAGATE_MAX_MINUTES = 24 * 60
 
-    def __init__(self, app, parent_wnd, img_preview_size):
+    def __init__(self, app, parent_wnd, img_preview_size, virtual=False, preview_workers=2):
+        """ In virtual mode rows and previews are only created for the part
+        of the list that is on screen, so memory use depends on the size of
+        the window instead of on the number of images. preview_workers is the
+        number of threads decoding previews. """
         self.panel = wx.Panel(parent_wnd, -1)
         self.app = app
         self.img_preview_size = img_preview_size
-        self.bg = None
+        self.virtual = virtual
 
         start_lbl = self.app.get_description_for(None)
         self.selection_detail = wx.StaticText(self.panel, -1, style=wx.TE_MULTILINE, label=start_lbl)
@@ -19,14 +56,27 @@ class ImgBrowser:
         start_lbl = '[Right click an image for larger preview]'
         self.map_detail = wx.StaticText(self.panel, -1, label=start_lbl)
 
+        self.write_status = wx.StaticText(self.panel, -1, label='')
+        self.write_failures = 0
+
         self.pos_set = wx.Button(self.panel, label="Set positions", size=(ImgBrowser.BUTTON_WIDTH, -1))
         self.pos_set.Bind(wx.EVT_BUTTON, self._on_pos_set_click)
 
         self.preview = wx.Button(self.panel, label="Preview", size=(ImgBrowser.BUTTON_WIDTH, -1))
         self.preview.Bind(wx.EVT_BUTTON, self._on_preview_requested)
 
+        self.propagate = wx.Button(self.panel, label="Copy to shots within")
+        self.propagate.Bind(wx.EVT_BUTTON, self._on_propagate_click)
+        self.propagate_minutes = wx.SpinCtrl(self.panel, min=1, max=ImgBrowser.PROPAGATE_MAX_MINUTES,
+                                             initial=ImgBrowser.PROPAGATE_MINUTES)
+        propagate_lbl = wx.StaticText(self.panel, -1, label="min")
+
         panel_size = (ImgBrowser.NAME_COL_WIDTH + ImgBrowser.COORDS_COL_WIDTH + img_preview_size[0] + ImgBrowser.CTRL_MARGIN, -1)
-        self.imgs = wx.ListCtrl(self.panel, style=wx.LC_REPORT|wx.BORDER_SUNKEN, size=panel_size)
+        if virtual:
+            self.imgs = _VirtualImgList(self.panel, panel_size, self)
+            self.imgs.Bind(wx.EVT_LIST_CACHE_HINT, self._on_virtual_cache_hint)
+        else:
+            self.imgs = wx.ListCtrl(self.panel, style=wx.LC_REPORT|wx.BORDER_SUNKEN, size=panel_size)
         self.imgs.Bind(wx.EVT_LIST_ITEM_SELECTED, self._on_selection)
         self.imgs.Bind(wx.EVT_LIST_ITEM_RIGHT_CLICK, self._on_preview_requested)
         self.imgs.InsertColumn(0, 'Preview', width=img_preview_size[0] + ImgBrowser.CTRL_MARGIN, format=wx.LIST_FORMAT_CENTRE)
@@ -36,87 +86,514 @@ class ImgBrowser:
         self.previews_lst = wx.ImageList(*img_preview_size)
         self.imgs.SetImageList(self.previews_lst, wx.IMAGE_LIST_SMALL)
 
+        # Images shown in the list, row i is self.rows[i]
+        self.rows = []
+        # Virtual mode only: row -> slot in previews_lst, least recently drawn first
+        self.slot_of_row = OrderedDict()
+        self.loader = PreviewLoader(self._load_preview, self._on_previews_loaded, wx.CallAfter,
+                                    workers=preview_workers)
+        self.imgs.Bind(wx.EVT_SIZE, self._on_list_resized)
+
         self.dir_select = wx.DirPickerCtrl(parent_wnd)
         self.dir_select.Bind(wx.EVT_DIRPICKER_CHANGED, self._on_path_selected)
 
+        self.recursive = wx.CheckBox(parent_wnd, label="Include subdirectories")
+        self.recursive.Bind(wx.EVT_CHECKBOX, self._on_path_selected)
+
+        self.watch = wx.CheckBox(parent_wnd, label="Watch for changes")
+        self.watch.Bind(wx.EVT_CHECKBOX, self._on_watch_toggled)
+
+        self.by_time = wx.CheckBox(parent_wnd, label="Sort by capture time")
+        self.by_time.Bind(wx.EVT_CHECKBOX, self._on_sort_toggled)
+        # Bumped on every directory change, to ignore changes reported for an old one
+        self.dir_generation = 0
+
+        self.map_pos = None
+        self.nearby = set()
+        self.nearby_attr = wx.ListItemAttr()
+        self.nearby_attr.SetBackgroundColour(wx.Colour(*ImgBrowser.NEARBY_COLOUR))
+
         box = wx.BoxSizer(wx.VERTICAL)
         topbox = wx.BoxSizer(wx.HORIZONTAL)
         topbox.Add(self.pos_set, 1, wx.ALL, ImgBrowser.CTRL_MARGIN)
         topbox.Add(self.preview, 1, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        propagatebox = wx.BoxSizer(wx.HORIZONTAL)
+        propagatebox.Add(self.propagate, 0, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        propagatebox.Add(self.propagate_minutes, 0, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        propagatebox.Add(propagate_lbl, 0, wx.ALL|wx.ALIGN_CENTER_VERTICAL, ImgBrowser.CTRL_MARGIN)
         box.Add(self.dir_select, 1, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        box.Add(self.recursive, 0, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        box.Add(self.watch, 0, wx.ALL, ImgBrowser.CTRL_MARGIN)
+        box.Add(self.by_time, 0, wx.ALL, ImgBrowser.CTRL_MARGIN)
         box.Add(topbox)
+        box.Add(propagatebox)
         box.Add(self.selection_detail)
         box.Add(self.map_detail)
+        box.Add(self.write_status)
         box.Add(self.imgs, wx.EXPAND)
         self.panel.SetSizer(box)
 
 
-    def _on_path_selected(self, _):
+    def _clear_rows(self):
+        # Anything still loading is for the old list. Cancelling doesn't wait
+        # for the workers, their results will be ignored.
+        self.loader.reset()
+        self.rows = []
+        self.slot_of_row = OrderedDict()
+
         # First clear list, otherwise the list may hold refs to a cleand up img
-        self.imgs.DeleteAllItems()
+        if self.virtual:
+            self.imgs.SetItemCount(0)
+        else:
+            self.imgs.DeleteAllItems()
         self.previews_lst.RemoveAll()
-        path = self.dir_select.GetPath()
-        row=0
-        for img in self.app.load_images_from(path):
+        if self.virtual:
+            # Slot 0 is always the placeholder, for rows without a preview yet
+            self.previews_lst.Add(self.app.get_placeholder_preview())
+
+
+    def _append_row(self, img):
+        row = len(self.rows)
+        self.rows.append(img)
+        if not self.virtual:
             browserimg=self.previews_lst.Add(img.preview)
             self.imgs.InsertItem(row, browserimg)
             self.imgs.SetItem(row, 1, img.coords_set)
-            self.imgs.SetItem(row, 2, img.fname)
-            row += 1
+            self.imgs.SetItem(row, 2, ImgBrowser._row_name(img))
+
+
+    @instrument.timed('ui.populate')
+    def _on_path_selected(self, _):
+        self.dir_generation += 1
+        self._clear_rows()
+
+        path = self.dir_select.GetPath()
+        if not path:
+            return
+        generation = self.dir_generation
+        on_scan_done = lambda: wx.CallAfter(self._on_scan_done, generation)
+        for img in self.app.iter_images_from(path, self._on_position_loaded, self.recursive.GetValue(),
+                                             on_scan_done):
+            self._append_row(img)
+            if len(self.rows) % ImgBrowser.ROWS_PER_REPAINT == 0:
+                if self.virtual:
+                    self.imgs.SetItemCount(len(self.rows))
+                # Show what's been found so far while a large tree is walked.
+                # SafeYield disables input, so this can't be re-entered.
+                wx.SafeYield(None, True)
+
+        if self.app.images_sorted_by_time():
+            # Rows were shown in the order they were found, switch to capture order
+            self._rebuild_rows()
+        else:
+            self._finish_rows()
+        if self.watch.GetValue():
+            self._start_watching()
+
+
+    def _on_scan_done(self, generation):
+        # Capture times of a parallel scan are only known now
+        if generation != self.dir_generation or not self.app.images_sorted_by_time():
+            return
+        self.app.sort_images_by_time(True)
+        self._rebuild_rows()
+
+
+    def _finish_rows(self):
+        self.nearby = set()
+        self._update_nearby()
+        if self.virtual:
+            # Previews will be requested as rows are drawn
+            self.imgs.SetItemCount(len(self.rows))
+            self.imgs.Refresh()
+        else:
+            self._update_loader_viewport()
+            self.loader.request([row for row, img in enumerate(self.rows)
+                                 if img.preview is self.app.get_placeholder_preview()])
+
+
+    def _on_watch_toggled(self, _):
+        if self.watch.GetValue():
+            self._start_watching()
+        else:
+            self.app.stop_watching()
+
+
+    def _start_watching(self):
+        generation = self.dir_generation
+        self.app.start_watching(lambda changes: wx.CallAfter(self._on_dir_changed, generation, changes))
+
+
+    def _on_dir_changed(self, generation, changes):
+        if generation != self.dir_generation:
+            return
+        modified = set(entry.path for entry in changes.modified)
+        self.app.apply_dir_changes(changes)
+
+        new_rows = list(self.app.get_loaded_images())
+        new_set = set(new_rows)
+        old_set = set(self.rows)
+        if [img for img in new_rows if img in old_set] != [img for img in self.rows if img in new_set]:
+            # Images that were already shown changed order (eg sorted by a
+            # capture time that changed), there's no point in moving rows one by one
+            self._rebuild_rows()
+            return
+
+        selected = self._get_selected_paths()
+        self.nearby &= new_set
+        if self.virtual:
+            self._apply_virtual_row_changes(new_rows, modified)
+        else:
+            self._apply_row_changes(new_rows, modified)
+        if self.virtual:
+            # Rows moved, so the selection of a virtual list points to other images now
+            self._select_only(selected)
+        self._update_nearby()
+
+
+    def _apply_row_changes(self, new_rows, modified):
+        """ Updates the rows of a non virtual list to new_rows, which has the
+        shown images in the same order, plus or minus some """
+        # Previews already shown are kept, unless the file changed
+        placeholder = self.app.get_placeholder_preview()
+        shown = {img: self.previews_lst.GetBitmap(row) for row, img in enumerate(self.rows)
+                 if img.path not in modified}
+
+        new_set = set(new_rows)
+        for row in reversed(range(len(self.rows))):
+            if self.rows[row] not in new_set:
+                self.imgs.DeleteItem(row)
+        old_set = set(self.rows)
+        for row, img in enumerate(new_rows):
+            if img not in old_set:
+                self.imgs.InsertItem(row, 0)
+            if img not in old_set or img.path in modified:
+                self.imgs.SetItem(row, 1, img.coords_set)
+                self.imgs.SetItem(row, 2, ImgBrowser._row_name(img))
+        self.rows = new_rows
+
+        # Slots of the image list must match rows again
+        self.loader.reset()
+        self.previews_lst.RemoveAll()
+        missing = []
+        for row, img in enumerate(self.rows):
+            bmp = shown.get(img)
+            if bmp is None:
+                bmp = img.preview
+                if bmp is placeholder:
+                    missing.append(row)
+            self.previews_lst.Add(bmp)
+            self.imgs.SetItemImage(row, row)
+        self.imgs.SetImageList(self.previews_lst, wx.IMAGE_LIST_SMALL)
+        self._update_loader_viewport()
+        self.loader.request(missing)
+
+
+    def _apply_virtual_row_changes(self, new_rows, modified):
+        row_of = {img: row for row, img in enumerate(new_rows)}
+        slot_of_row = OrderedDict()
+        reload = []
+        for row, slot in self.slot_of_row.items():
+            img = self.rows[row]
+            if img in row_of:
+                slot_of_row[row_of[img]] = slot
+                if img.path in modified:
+                    # Shows the old preview until the new one is loaded
+                    reload.append(row_of[img])
+        self.rows = new_rows
+        self.slot_of_row = slot_of_row
+        # Pending requests are for the old row numbers
+        self.loader.reset()
+        self.imgs.SetItemCount(len(self.rows))
+        self.imgs.Refresh()
+        self.loader.request(reload)
+
+
+    def _select_only(self, fnames):
+        row = self.imgs.GetFirstSelected()
+        while row != -1:
+            self.imgs.Select(row, False)
+            row = self.imgs.GetNextSelected(row)
+        for fname in fnames:
+            row = self.app.get_row_for(fname)
+            if row is not None and row < len(self.rows):
+                self.imgs.Select(row)
+
 
-        if self.bg:
-            self.bg.join()
-        self.bg = threading.Thread(target=self._previews_bg_load)
-        self.bg.start()
+    def _on_sort_toggled(self, _):
+        self.app.sort_images_by_time(self.by_time.GetValue())
+        self._rebuild_rows()
 
 
-    def _previews_bg_load(self):
-        for i in range(self.imgs.GetItemCount()):
-            fname = self.imgs.GetItem(i, 2).GetText()
-            preview = self.app.get_image_preview(fname)
-            self.previews_lst.Replace(i, preview)
-            if self.imgs.IsVisible(i):
-                # The only way to refresh the items in the list seem to be to
-                # change the scroll position or to re-set its image list.
-                # Calling .RefreshItem(i), .Refresh() or .Update() doesn't work
-                self.imgs.SetImageList(self.previews_lst, wx.IMAGE_LIST_SMALL)
+    def _rebuild_rows(self):
+        """ Shows the images loaded in the app again, in their current order """
+        # Unchanged images keep their position and cached preview, so
+        # rebuilding the rows is cheap. Keep what the user was looking at.
+        selected = set(self._get_selected_paths())
+        top = self.rows[self.imgs.GetTopItem()] if 0 <= self.imgs.GetTopItem() < len(self.rows) else None
+        self._clear_rows()
+        for img in self.app.get_loaded_images():
+            self._append_row(img)
+        self._finish_rows()
+        self._restore_view(selected, top)
+
+
+    def _restore_view(self, selected, top):
+        self._select_only(selected)
+        row = self._row_of(top) if top is not None else None
+        if row is not None:
+            # EnsureVisible only scrolls as little as needed, show the last
+            # row of the page first so that row ends up at the top
+            page = self.imgs.GetCountPerPage()
+            self.imgs.EnsureVisible(min(len(self.rows) - 1, row + page - 1))
+            self.imgs.EnsureVisible(row)
+
+
+    def _load_preview(self, row):
+        # Runs in a loader worker, can't touch any wx window
+        rows = self.rows
+        if row >= len(rows):
+            return None
+        return (rows[row].fname, self.app.load_preview(rows[row].fname))
+
+
+    def _on_previews_loaded(self, batch):
+        any_visible = False
+        for row, (fname, preview) in batch:
+            if row >= len(self.rows) or self.rows[row].fname != fname:
+                continue
+            bmp = self.app.preview_to_bitmap(fname, preview)
+            if self.virtual:
+                self._set_virtual_preview(row, bmp)
+            else:
+                self.previews_lst.Replace(row, bmp)
+                any_visible = any_visible or self.imgs.IsVisible(row)
+
+        if any_visible:
+            # The only way to refresh the items in the list seem to be to
+            # change the scroll position or to re-set its image list.
+            # Calling .RefreshItem(i), .Refresh() or .Update() doesn't work
+            self.imgs.SetImageList(self.previews_lst, wx.IMAGE_LIST_SMALL)
+
+        if not self.virtual:
+            # There's no scroll event that works everywhere, but while
+            # previews are loading batches keep coming: use them to follow
+            # the user's scrolling
+            self._update_loader_viewport()
+
+
+    def _update_loader_viewport(self):
+        first = self.imgs.GetTopItem()
+        page = self.imgs.GetCountPerPage()
+        self.loader.set_viewport(first, first + page - 1, page)
+
+
+    def _on_list_resized(self, evt):
+        evt.Skip()
+        if not self.virtual:
+            self._update_loader_viewport()
+
+
+    def _virtual_item_text(self, row, col):
+        if row >= len(self.rows):
+            return ''
+        if col == 1:
+            return self.rows[row].coords_set
+        if col == 2:
+            return ImgBrowser._row_name(self.rows[row])
+        return ''
 
 
     @staticmethod
-    def _get_selected_paths(lst):
-        item = lst.GetFirstSelected()
+    def _row_name(img):
+        if len(img.companions) == 0:
+            return img.fname
+        # Tags apply to the RAW files too, show they're there
+        exts = [os.path.splitext(path)[1][1:].upper() for path in img.companions]
+        return f"{img.fname} (+{', '.join(exts)})"
+
+
+    def _virtual_item_attr(self, row):
+        if row < len(self.rows) and self.rows[row] in self.nearby:
+            return self.nearby_attr
+        return None
+
+
+    def _virtual_item_image(self, row):
+        slot = self.slot_of_row.get(row)
+        if slot is not None:
+            self.slot_of_row.move_to_end(row)
+            return slot
+        self.loader.request([row])
+        return 0
+
+
+    def _on_virtual_cache_hint(self, evt):
+        """ The list is about to draw rows [from, to]. Also prefetch previews
+        for one page above and below, so that scrolling a bit shows them. """
+        first, last = evt.GetCacheFrom(), evt.GetCacheTo()
+        page = last - first + 1
+        # Rows that scrolled further away than a page are dropped from the queue
+        self.loader.set_viewport(first, last, page, drop_far=True)
+        near = range(max(0, first - page), min(len(self.rows), last + page + 1))
+        self.loader.request([r for r in near if r not in self.slot_of_row])
+
+
+    def _set_virtual_preview(self, row, bmp):
+        max_slots = max(ImgBrowser.VIRTUAL_MIN_PREVIEWS, 3 * self.imgs.GetCountPerPage())
+        if row in self.slot_of_row:
+            slot = self.slot_of_row[row]
+            self.previews_lst.Replace(slot, bmp)
+        elif len(self.slot_of_row) < max_slots:
+            slot = self.previews_lst.Add(bmp)
+        else:
+            # Reuse the slot of the least recently drawn row
+            old_row, slot = self.slot_of_row.popitem(last=False)
+            self.previews_lst.Replace(slot, bmp)
+            self.imgs.RefreshItem(old_row)
+        self.slot_of_row[row] = slot
+        self.imgs.RefreshItem(row)
+
+
+    def _on_position_loaded(self, img):
+        # Called from the scan workers, the list can only be touched from the UI thread
+        wx.CallAfter(self._update_position_column, img)
+
+
+    def _row_of(self, img):
+        """ Returns the row showing img, or None if it's not in the list
+        (eg because it's from a directory that isn't shown anymore) """
+        row = self.app.get_row_for(img.fname)
+        if row is None:
+            return None
+        return row if row < len(self.rows) and self.rows[row] is img else None
+
+
+    def _set_row_coords(self, row, img):
+        if self.virtual:
+            self.imgs.RefreshItem(row)
+        else:
+            self.imgs.SetItem(row, 1, img.coords_set)
+
+
+    def _update_position_column(self, img):
+        row = self._row_of(img)
+        if row is not None:
+            self._set_row_coords(row, img)
+
+
+    def _get_selected_paths(self):
+        item = self.imgs.GetFirstSelected()
         paths = []
         while item != -1:
-            paths.append(lst.GetItem(item, 2).GetText())
-            item = lst.GetNextSelected(item)
+            paths.append(self.rows[item].fname)
+            item = self.imgs.GetNextSelected(item)
         return paths
 
 
+    def _preview_neighbors(self, fname):
+        """ Images the user may preview after fname: the ones right before and after it """
+        row = self.app.get_row_for(fname)
+        if row is None:
+            return []
+        return [self.rows[r].fname for r in (row + 1, row - 1) if 0 <= r < len(self.rows)]
+
+
     def _on_preview_requested(self, _):
-        paths = ImgBrowser._get_selected_paths(self.imgs)
+        paths = self._get_selected_paths()
         if paths is None or len(paths) == 0:
             return
-        self.app.on_preview_requested(paths[0])
+        self.app.on_preview_requested(paths[0], self._preview_neighbors(paths[0]))
 
 
     def _on_selection(self, _):
-        paths = ImgBrowser._get_selected_paths(self.imgs)
+        paths = self._get_selected_paths()
         self.selection_detail.SetLabel(self.app.get_description_for(paths))
+        if self.app.preview_active and len(paths) > 0:
+            # Flip through images while the large preview is open
+            self.app.show_preview(paths[0], self._preview_neighbors(paths[0]))
 
     
     def _on_pos_set_click(self, _):
-        paths = ImgBrowser._get_selected_paths(self.imgs)
-        self.app.set_gps_coords_for(paths)
+        paths = self._get_selected_paths()
+        self.write_failures = 0
+        self.app.set_gps_coords_for(paths, self._on_position_written)
+        self._show_tagged(paths)
         self.selection_detail.SetLabel(self.app.get_description_for(paths))
 
-        # Update selected rows to pos set=true
-        item = self.imgs.GetFirstSelected()
-        while item != -1:
-            self.imgs.SetItem(item, 1, 'Y')
-            item = self.imgs.GetNextSelected(item)
+
+    def _on_propagate_click(self, _):
+        paths = self._get_selected_paths()
+        if len(paths) != 1:
+            self.write_status.SetLabel("Select the one photo to copy the position from")
+            return
+        minutes = self.propagate_minutes.GetValue()
+        self.write_failures = 0
+        targets = self.app.propagate_position_from(paths[0], minutes * 60, self._on_position_written)
+        if len(targets) == 0:
+            self.write_status.SetLabel(f"Nothing to copy: no position, or no untagged photos within {minutes} min")
+        else:
+            self._show_tagged(targets)
+
+
+    def _show_tagged(self, fnames):
+        """ Positions are visible as soon as they're set, even if the files
+        are written later """
+        for fname in fnames:
+            row = self.app.get_row_for(fname)
+            if row is not None and row < len(self.rows):
+                self._set_row_coords(row, self.rows[row])
+        self._update_nearby()
+        pending = self.app.get_pending_writes()
+        if pending > 0:
+            self.write_status.SetLabel(f"Writing positions: {pending} left")
+
+
+    def _on_position_written(self, img, pos, ok, pending):
+        # May be called from a writer thread
+        wx.CallAfter(self._update_written_row, img, ok, pending)
+
+
+    def _update_written_row(self, img, ok, pending):
+        row = self._row_of(img)
+        if row is not None:
+            self._set_row_coords(row, img)
+
+        if not ok:
+            self.write_failures += 1
+        failed = f", {self.write_failures} failed" if self.write_failures > 0 else ''
+        if pending > 0:
+            self.write_status.SetLabel(f"Writing positions: {pending} left{failed}")
+        else:
+            self.write_status.SetLabel(f"All positions written{failed}")
+            paths = self._get_selected_paths()
+            self.selection_detail.SetLabel(self.app.get_description_for(paths))
 
 
     def map_moved_to(self, pos):
+        self.map_pos = pos
+        self._update_nearby()
+
+
+    def _update_nearby(self):
+        """ Highlights the photos close to the map center """
+        nearby = self.app.get_images_near(self.map_pos, ImgBrowser.NEARBY_RADIUS_M)
+        new_nearby = set(nearby)
+        if self.virtual:
+            if new_nearby != self.nearby:
+                self.nearby = new_nearby
+                self.imgs.Refresh()
+        else:
+            for img in new_nearby ^ self.nearby:
+                row = self._row_of(img)
+                if row is not None:
+                    colour = ImgBrowser.NEARBY_COLOUR if img in new_nearby else wx.NullColour
+                    self.imgs.SetItemBackgroundColour(row, colour)
+            self.nearby = new_nearby
+
         # TODO: This belongs one level up, but first I need to add a vertical layout
-        self.map_detail.SetLabel(f"Map position: {pos}")
+        label = f"Map position: {self.map_pos}"
+        if self.map_pos is not None:
+            label += f"\n{len(nearby)} photos within {ImgBrowser.NEARBY_RADIUS_M} m"
+        self.map_detail.SetLabel(label)
 
@@ -0,0 +1,82 @@
+""" Decoding of images at reduced sizes. Decoding a full 40 MP JPEG only to
+scale it down to a small preview wastes most of the work, so these helpers
+try cheaper sources first: the thumbnail embedded in the EXIF block, then a
+DCT-scaled decode (1/2, 1/4 or 1/8 of the original size). """
+
+from jpeg_exif import read_exif_thumbnail
+import io
+import wx
+
+# PIL.Image once loaded, or None if it isn't installed
+_pil_image = None
+_pil_loaded = False
+
+
+def _load_pil():
+    """ Optional: PIL can ask libjpeg for a reduced size decode, wx can't.
+    Imported on first use, it isn't needed until the first preview. """
+    global _pil_image, _pil_loaded
+    if not _pil_loaded:
+        try:
+            from PIL import Image
+            _pil_image = Image
+        except ImportError:
+            _pil_image = None
+        _pil_loaded = True
+    return _pil_image
+
+
+def decode_scaled(path, size):
+    """ Decodes path into a wx.Image at least as large as size, using the
+    smallest DCT scale that allows it. Returns None if that's not possible
+    (PIL not installed, or not a JPEG). """
+    pil_image = _load_pil()
+    if pil_image is None:
+        return None
+    try:
+        with pil_image.open(path) as im:
+            if im.format != 'JPEG':
+                return None
+            im.draft('RGB', size)
+            im = im.convert('RGB')
+            return wx.Image(im.width, im.height, im.tobytes())
+    except Exception:
+        return None
+
+
+def decode_thumbnail(path):
+    """ Returns the EXIF embedded thumbnail of path as a wx.Image, or None """
+    thumb = read_exif_thumbnail(path)
+    if thumb is None:
+        return None
+    img = wx.Image(io.BytesIO(thumb), wx.BITMAP_TYPE_JPEG)
+    return img if img.IsOk() else None
+
+
+def decode_for_size(path, size, allow_thumbnail=True):
+    """ Returns a wx.Image for path that can be scaled down to size, doing as
+    little work as possible. Falls back to a full decode. """
+    if allow_thumbnail:
+        img = decode_thumbnail(path)
+        if img is not None:
+            return img
+
+    img = decode_scaled(path, size)
+    if img is not None:
+        return img
+
+    return wx.Image(path, wx.BITMAP_TYPE_ANY)
+
+
+def encode_jpeg(img):
+    """ Returns the JPEG encoding of a wx.Image, eg to store it in a cache """
+    out = io.BytesIO()
+    if not img.SaveFile(out, wx.BITMAP_TYPE_JPEG):
+        return None
+    return out.getvalue()
+
+
+def decode_jpeg(data):
+    """ Reverse of encode_jpeg. Returns None if data isn't a valid image """
+    img = wx.Image(io.BytesIO(data), wx.BITMAP_TYPE_JPEG)
+    return img if img.IsOk() else None
@@ -1,11 +1,22 @@
 from fractions import Fraction
+from jpeg_exif import UnsupportedExif, read_gps, read_gps_and_time
+import instrument
 import math
-import pyexiv2
+import os
+import xmp_sidecar
 
 LAT_KEY = 'Exif.GPSInfo.GPSLatitude'
 LON_KEY = 'Exif.GPSInfo.GPSLongitude'
 LAT_REF_KEY = 'Exif.GPSInfo.GPSLatitudeRef'
 LON_REF_KEY = 'Exif.GPSInfo.GPSLongitudeRef'
+DATETIME_ORIGINAL_KEY = 'Exif.Photo.DateTimeOriginal'
+
+
+def _pyexiv2():
+    # pyexiv2 loads a large native library. Most reads never need it, so
+    # only pay for it the first time the fast path can't handle a file.
+    import pyexiv2
+    return pyexiv2
 
 
 def dec_to_sex(x):
@@ -45,38 +56,145 @@ def frac_to_dec(f):
     return sex_to_dec(f) if f else None
 
 
+def format_position(lat, lon):
+    """ Formats a decimal (lat, lon) the same way get_exif_position does """
+    lat_ref = 'S' if lat < 0 else 'N'
+    lon_ref = 'W' if lon < 0 else 'E'
+    return f"{abs(lat):.5f}{lat_ref} {abs(lon):.5f}{lon_ref}"
+
+
+def _format_exif_position(path, lat, lat_ref, lon, lon_ref):
+    if lat is None or lon is None:
+        print(f"Error loading position for {path}, lat/lon wasn't a number")
+        return None
+
+    if lat_ref.upper() not in ['N', 'S']:
+        print(f"Error loading position for {path}, lat ref wasn't valid")
+        return None
+
+    if lon_ref.upper() not in ['W', 'E']:
+        print(f"Error loading position for {path}, lon ref wasn't valid")
+        return None
+
+    return f"{lat:.5f}{lat_ref} {lon:.5f}{lon_ref}"
+
+
+def parse_position(pos):
+    """ Reverse of format_position: returns (lat, lon) as signed decimals, or
+    None if pos isn't a valid position string """
+    try:
+        lat, lon = pos.split()
+        lat_v = float(lat[:-1]) * (-1 if lat[-1].upper() == 'S' else 1)
+        lon_v = float(lon[:-1]) * (-1 if lon[-1].upper() == 'W' else 1)
+        return (lat_v, lon_v)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_sidecar_position(path):
+    """ Returns the position stored in the XMP sidecar of path, or None """
+    gps = xmp_sidecar.read_gps(path)
+    if gps is None:
+        return None
+    lat, lat_ref, lon, lon_ref = gps
+    return _format_exif_position(path, lat, lat_ref, lon, lon_ref)
+
+
+@instrument.timed('exif.read_position')
 def get_exif_position(path):
+    """ Reads the position of path. A position in an XMP sidecar takes
+    priority over the one in the file. Tries a minimal parser that only
+    reads the EXIF block at the start of the file, and only if that can't
+    handle the file loads it with pyexiv2. """
+    pos = get_sidecar_position(path)
+    if pos is not None:
+        return pos
+    try:
+        gps = read_gps(path)
+    except UnsupportedExif:
+        instrument.count('exif.fast_path_fallback')
+        return get_exif_position_pyexiv2(path)
+
+    return _position_from_gps(path, gps)
+
+
+@instrument.timed('exif.read_metadata')
+def get_exif_metadata(path):
+    """ Reads the position and the DateTimeOriginal string of path in a
+    single pass, as (position, datetime). Either may be None. A position in
+    an XMP sidecar takes priority over the one in the file. """
+    try:
+        gps, taken = read_gps_and_time(path)
+        pos = _position_from_gps(path, gps)
+    except UnsupportedExif:
+        instrument.count('exif.fast_path_fallback')
+        pos, taken = get_exif_metadata_pyexiv2(path)
+    sidecar_pos = get_sidecar_position(path)
+    return (sidecar_pos if sidecar_pos is not None else pos), taken
+
+
+def _position_from_gps(path, gps):
+    if gps is None:
+        return None
+    lat, lat_ref, lon, lon_ref = gps
+    return _format_exif_position(path, sex_to_dec(lat), lat_ref, sex_to_dec(lon), lon_ref)
+
+
+def _read_exif_pyexiv2(path):
+    """ Returns the EXIF dict of path, or None if it can't be read """
+    try:
+        img = _pyexiv2().Image(path)
+    except RuntimeError:
+        print(f"Error loading metadata for {path}")
+        return None
+
     try:
-        meta = pyexiv2.Image(path).read_exif()
+        return img.read_exif()
     except RuntimeError:
         print(f"Error loading metadata for {path}")
         return None
+    finally:
+        img.close()
 
+
+def _position_from_meta(path, meta):
     try:
-        lat = frac_to_dec(meta[LAT_KEY])
-        lon = frac_to_dec(meta[LON_KEY])
-        if lat is None or lon is None:
-            print(f"Error loading position for {path}, lat/lon wasn't a number")
-            return None
-
-        lat_ref = meta[LAT_REF_KEY]
-        if lat_ref.upper() not in ['N', 'S']:
-            print(f"Error loading position for {path}, lat ref wasn't valid")
-            return None
-
-        lon_ref = meta[LON_REF_KEY]
-        if lon_ref.upper() not in ['W', 'E']:
-            print(f"Error loading position for {path}, lon ref wasn't valid")
-            return None
-
-        return f"{lat:.5f}{lat_ref} {lon:.5f}{lon_ref}"
+        return _format_exif_position(path, frac_to_dec(meta[LAT_KEY]), meta[LAT_REF_KEY],
+                                     frac_to_dec(meta[LON_KEY]), meta[LON_REF_KEY])
     except KeyError:
         return None
 
 
+def get_exif_position_pyexiv2(path):
+    meta = _read_exif_pyexiv2(path)
+    return _position_from_meta(path, meta) if meta is not None else None
+
+
+def get_exif_metadata_pyexiv2(path):
+    meta = _read_exif_pyexiv2(path)
+    if meta is None:
+        return None, None
+    return _position_from_meta(path, meta), meta.get(DATETIME_ORIGINAL_KEY)
+
+
+@instrument.timed('exif.read_datetime')
+def get_exif_datetime(path):
+    """ Returns the DateTimeOriginal string of path ('YYYY:MM:DD HH:MM:SS') """
+    try:
+        return read_gps_and_time(path)[1]
+    except UnsupportedExif:
+        instrument.count('exif.fast_path_fallback')
+        meta = _read_exif_pyexiv2(path)
+        return meta.get(DATETIME_ORIGINAL_KEY) if meta is not None else None
+
+
+@instrument.timed('exif.write_position')
 def set_exif_position(path, coords):
+    """ Writes coords to the EXIF of path. A sidecar left by an earlier
+    --sidecar run or by another tool would still win when reading, so if
+    there is one its position is updated too. """
     try:
-        img = pyexiv2.Image(path)
+        img = _pyexiv2().Image(path)
     except RuntimeError:
         print(f"Error loading image metadata for {path}")
         return False
@@ -87,12 +205,27 @@ def set_exif_position(path, coords):
     lat_ref = 'S' if lat < 0 else 'N'
     lon_ref = 'W' if lon < 0 else 'E'
 
-    img.modify_exif({
-        LAT_KEY: frac_lat,
-        LON_KEY: frac_lon,
-        LAT_REF_KEY: lat_ref,
-        LON_REF_KEY: lon_ref,
-    })
+    try:
+        img.modify_exif({
+            LAT_KEY: frac_lat,
+            LON_KEY: frac_lon,
+            LAT_REF_KEY: lat_ref,
+            LON_REF_KEY: lon_ref,
+        })
+    except RuntimeError:
+        print(f"Error writing image metadata for {path}")
+        return False
+    finally:
+        # Release the file handle right away, don't wait for the GC
+        img.close()
 
+    if os.path.isfile(xmp_sidecar.sidecar_path(path)):
+        return xmp_sidecar.write_gps(path, coords)
     return True
 
+
+@instrument.timed('exif.write_sidecar')
+def set_sidecar_position(path, coords):
+    """ Same as set_exif_position, but writes to the XMP sidecar of path
+    instead of rewriting the file """
+    return xmp_sidecar.write_gps(path, coords)
@@ -1,62 +1,486 @@
-from img_exif import get_exif_position, set_exif_position
+from collections import OrderedDict
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from dir_watcher import DirWatcher
+from exif_writer import ExifWriter
+from img_decode import decode_for_size, decode_jpeg, encode_jpeg
+from gpx_track import parse_exif_time
+from img_exif import format_position, get_exif_metadata, parse_position, set_exif_position, set_sidecar_position
+from img_scan import ALLOWED_EXTENSIONS, scan
+import instrument
+from position_cache import PositionCache
+from spatial_index import GridIndex
+from time_index import TimeIndex
 import math
 import os
+import sqlite3
 import sys
 import tempfile
 import threading
 import wx
 
 
-# Named tuples are immutable
+# Named tuples are immutable. Slots keep each record small for large folders.
 class Img:
-    def __init__(self, preview, path, fname, coords_set):
+    __slots__ = ('preview', 'path', 'fname', 'coords_set', 'companions')
+
+    def __init__(self, preview, path, fname, coords_set, companions=()):
         self.preview = preview
         self.path = path
         self.fname = fname
         self.coords_set = coords_set
+        # RAW files paired with this image
+        self.companions = companions
+
+
+class PreviewLRU:
+    """ Keeps the most recently used preview bitmaps, up to max_bytes of
+    pixel data. Evicted images get their preview reset to the placeholder. """
+
+    def __init__(self, max_bytes, placeholder):
+        self.max_bytes = max_bytes
+        self.placeholder = placeholder
+        self._lock = threading.Lock()
+        # Img -> size in bytes of its preview
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    @staticmethod
+    def bitmap_bytes(bmp):
+        depth = bmp.GetDepth() if bmp.GetDepth() > 0 else 32
+        return bmp.GetWidth() * bmp.GetHeight() * ((depth + 7) // 8)
+
+
+    def get(self, img):
+        """ Returns the cached preview of img, or None """
+        with self._lock:
+            if img in self._entries:
+                self._entries.move_to_end(img)
+                self.hits += 1
+                return img.preview
+            self.misses += 1
+            return None
+
+
+    def put(self, img, preview):
+        nbytes = PreviewLRU.bitmap_bytes(preview)
+        with self._lock:
+            if img in self._entries:
+                self.total_bytes -= self._entries.pop(img)
+            img.preview = preview
+            self._entries[img] = nbytes
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                old, old_bytes = self._entries.popitem(last=False)
+                old.preview = self.placeholder
+                self.total_bytes -= old_bytes
+                self.evictions += 1
+
+
+    def discard(self, img):
+        with self._lock:
+            nbytes = self._entries.pop(img, None)
+            if nbytes is not None:
+                self.total_bytes -= nbytes
+            img.preview = self.placeholder
+
+
+    def clear(self):
+        with self._lock:
+            for img in self._entries:
+                img.preview = self.placeholder
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
 
 
 class ImgManager:
-    def __init__(self, preview_size, start_path=None):
-        self._allowed_extensions = ['JPG', 'JPEG']
+    # Value of Img.coords_set while a parallel scan hasn't read the file yet
+    COORDS_PENDING = '?'
+    # Value of Img.coords_set while a new position is waiting to be written
+    COORDS_WRITING = 'Y*'
+    # Number of scanned positions written to the persistent cache at once
+    POSITION_CACHE_BATCH = 256
+    DEFAULT_PREVIEW_CACHE_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, preview_size, start_path=None, scan_workers=0, scan_use_processes=False,
+                 position_cache=None, thumbnail_cache=None, write_workers=0, write_delay=0, sidecars=False,
+                 exclude=(), preview_cache_bytes=DEFAULT_PREVIEW_CACHE_BYTES,
+                 placeholder_path='./loading.png'):
+        """ scan_workers > 0 reads positions in a background pool of that
+        many workers instead of serially during reload. Threads are used
+        unless scan_use_processes is set. position_cache is an optional
+        PositionCache, used to skip EXIF reads of files seen before.
+        thumbnail_cache is an optional ThumbnailCache for previews.
+        write_workers > 0 makes set_positions_for write files in the
+        background instead of blocking until every file is written; each
+        file is then only written once it hasn't been re-tagged for
+        write_delay seconds. With sidecars positions are written to XMP
+        sidecars instead of to the images, which is a few KB per file instead
+        of a full rewrite, and also covers the RAW files paired with each
+        JPEG. Otherwise only the JPEG is written.
+        exclude is a list of glob patterns of files and dirs to skip.
+        preview_cache_bytes caps the memory used by preview bitmaps.
+        placeholder_path is the image shown for previews not loaded yet; with
+        None no bitmap is created, so no display is needed (eg benchmarks). """
+        self._allowed_extensions = ALLOWED_EXTENSIONS
+        self.exclude = exclude
         self.preview_size = preview_size
+        self.position_cache = position_cache
+        self.thumbnail_cache = thumbnail_cache
+        self.scan_workers = scan_workers
+        self.scan_use_processes = scan_use_processes
         self.imgs = []
+        # fname -> Img and fname -> index in self.imgs (which is also the row in the UI)
+        self.imgs_by_fname = {}
+        self.rows_by_fname = {}
+        self.imgs_by_path = {}
+        self.positions_cache = {}
+        # While a serial scan runs, entries for the persistent cache are kept
+        # here and written in batches instead of one transaction per file
+        self._cache_writes = None
+        # Positions of the files in positions_cache, by path
+        self.spatial_index = GridIndex()
+        # DateTimeOriginal string of each file read so far, and the same
+        # times as seconds, sorted, for the files that have one
+        self.capture_times = {}
+        self.time_index = TimeIndex()
+        # List images by capture time instead of by name
+        self.time_sorted = False
         self.bg = None
-        self.preview_not_loaded = self.build_preview('./loading.png')
+        self._scan_generation = 0
+        self.path = None
+        self.recursive = False
+        self.watcher = None
+        self.exif_writer = None
+        self._on_written = None
+        self._write_position = set_sidecar_position if sidecars else set_exif_position
+        if write_workers > 0:
+            self.exif_writer = ExifWriter(write_workers, self._on_position_written, delay=write_delay,
+                                          write=self._write_position)
+        self.preview_not_loaded = wx.NullBitmap
+        if placeholder_path is not None:
+            self.preview_not_loaded = self._build_placeholder(placeholder_path)
+        self.previews = PreviewLRU(preview_cache_bytes, self.preview_not_loaded)
         if start_path is not None:
             self.reload(start_path)
 
 
-    def reload(self, path):
+    @instrument.timed('manager.reload')
+    def reload(self, path, on_position_loaded=None, recursive=False, on_scan_done=None):
+        """ Loads the list of images in path. If a parallel scan is enabled
+        this returns before positions are known; on_position_loaded(img)
+        is then invoked from a background thread as each one arrives, and
+        on_scan_done() once all of them are known (and, if sorted by time,
+        the list has been sorted again). """
+        for _ in self.iter_reload(path, on_position_loaded, recursive, on_scan_done):
+            pass
+
+
+    def iter_reload(self, path, on_position_loaded=None, recursive=False, on_scan_done=None):
+        """ Same as reload, but yields each Img as soon as it's found, so the
+        caller can show it before the whole directory has been walked. In
+        recursive mode, Img.fname is the path relative to path. """
+        # Any scan still running for the previous path will stop reporting
+        self._scan_generation += 1
+        self.stop_watching()
+        self.path = path
+        self.recursive = recursive
+        self.previews.clear()
         self.imgs = []
+        self.imgs_by_fname = {}
+        self.rows_by_fname = {}
+        self.imgs_by_path = {}
         self.positions_cache = {}
+        self.spatial_index.clear()
+        self.capture_times = {}
+        self.time_index.clear()
         if not os.path.isdir(path): return
 
-        for fp in self.ls(path):
-            try:
-                self.imgs.append(Img(preview=self.preview_not_loaded,
-                                     path=fp,
-                                     fname=os.path.split(fp)[1],
-                                     coords_set=self.has_coords(fp)))
-            except:
-                print(f"Error loading {fp}", sys.exc_info()[0])
+        parallel = self.scan_workers > 0
+        batch = self._begin_cache_batch()
+        try:
+            for entry in scan(path, recursive, self._allowed_extensions, self.exclude):
+                try:
+                    coords_set = ImgManager.COORDS_PENDING if parallel else self.has_coords(entry.path)
+                    img = Img(preview=self.preview_not_loaded,
+                              path=entry.path,
+                              fname=entry.relpath,
+                              coords_set=coords_set,
+                              companions=entry.companions)
+                    self.imgs_by_fname[img.fname] = img
+                    self.rows_by_fname[img.fname] = len(self.imgs)
+                    self.imgs_by_path[img.path] = img
+                    self.imgs.append(img)
+                except:
+                    print(f"Error loading {entry.path}", sys.exc_info()[0])
+                    continue
+                yield img
+        finally:
+            self._end_cache_batch(batch)
+
+        if self.time_sorted and not parallel:
+            # With a parallel scan capture times aren't known yet, the list
+            # is sorted when the scan is done
+            self._sort_imgs()
+
+        if parallel:
+            self.bg = threading.Thread(target=self._bg_scan,
+                                       args=(self._scan_generation, list(self.imgs), on_position_loaded,
+                                             on_scan_done),
+                                       daemon=True)
+            self.bg.start()
+
+
+    def start_watching(self, on_changes, poll_interval=2.0):
+        """ Watches the loaded path for changes. on_changes(DirChanges) is
+        called from a background thread; the changes should be handed to
+        apply_changes from the thread that owns this ImgManager. """
+        self.stop_watching()
+        if self.path is None or not os.path.isdir(self.path):
+            return
+        self.watcher = DirWatcher(self.path, on_changes, self.recursive, self._allowed_extensions,
+                                  self.exclude, poll_interval)
+
+
+    def stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+
+    def apply_changes(self, changes):
+        """ Updates the list of images with a DirChanges. Only files that
+        changed get their position and preview read again. """
+        batch = self._begin_cache_batch()
+        try:
+            self._apply_changes(changes)
+        finally:
+            self._end_cache_batch(batch)
+
+
+    def _apply_changes(self, changes):
+        for path in changes.removed:
+            img = self.imgs_by_path.pop(path, None)
+            if img is None:
+                continue
+            self.imgs.remove(img)
+            self.imgs_by_fname.pop(img.fname, None)
+            self._forget_metadata(path)
+            self.previews.discard(img)
+
+        for entry in changes.modified:
+            img = self.imgs_by_path.get(entry.path)
+            if img is None:
+                continue
+            img.companions = entry.companions
+            if self.exif_writer is not None and self.exif_writer.is_pending(entry.path):
+                # Most likely our own write. What's on disk is already
+                # outdated, keep the position that is waiting to be written.
+                continue
+            self._forget_metadata(entry.path)
+            self.previews.discard(img)
+            img.coords_set = self.has_coords(entry.path)
+
+        fnames = [img.fname for img in self.imgs]
+        for entry in changes.added:
+            if entry.path in self.imgs_by_path:
+                continue
+            img = Img(preview=self.preview_not_loaded,
+                      path=entry.path,
+                      fname=entry.relpath,
+                      coords_set=self.has_coords(entry.path),
+                      companions=entry.companions)
+            # Keep the list sorted by name, as the initial listing was
+            idx = bisect_left(fnames, img.fname)
+            fnames.insert(idx, img.fname)
+            self.imgs.insert(idx, img)
+            self.imgs_by_fname[img.fname] = img
+            self.imgs_by_path[img.path] = img
+
+        if self.time_sorted:
+            self._sort_imgs()
+        else:
+            self.rows_by_fname = {img.fname: row for row, img in enumerate(self.imgs)}
+
+
+    def _forget_metadata(self, path):
+        self.positions_cache.pop(path, None)
+        self.spatial_index.remove(path)
+        self.capture_times.pop(path, None)
+        self.time_index.remove(path)
+
+
+    @instrument.timed('manager.bg_scan')
+    def _bg_scan(self, generation, imgs, on_position_loaded, on_scan_done=None):
+        # Files known to the persistent cache only cost a stat, report them first
+        to_read = []
+        for img in imgs:
+            if generation != self._scan_generation:
+                return
+            meta = self._cached_metadata(img.path)
+            if meta is PositionCache.MISS:
+                to_read.append(img)
+            else:
+                self._on_scanned(img, meta, on_position_loaded)
+
+        # New entries are written to the persistent cache in batches, one
+        # transaction per file is far slower than the EXIF read itself
+        to_store = []
+        pool_cls = ProcessPoolExecutor if self.scan_use_processes else ThreadPoolExecutor
+        with pool_cls(max_workers=self.scan_workers) as pool:
+            pending = {pool.submit(get_exif_metadata, img.path): img for img in to_read}
+            for done in as_completed(pending):
+                if generation != self._scan_generation:
+                    # A new path was loaded, drop whatever hasn't started yet
+                    for fut in pending:
+                        fut.cancel()
+                    break
+
+                img = pending[done]
+                try:
+                    pos, taken = done.result()
+                except:
+                    print(f"Error loading coords for {img.path}", sys.exc_info()[0])
+                    continue
+
+                to_store.append((img.path, pos, taken))
+                if len(to_store) >= ImgManager.POSITION_CACHE_BATCH:
+                    self._store_cached_positions(to_store)
+                    to_store = []
+                self._on_scanned(img, (pos, taken), on_position_loaded)
+
+        self._store_cached_positions(to_store)
+        if generation == self._scan_generation and on_scan_done is not None:
+            on_scan_done()
+
+
+    def _on_scanned(self, img, meta, on_position_loaded):
+        pos, taken = meta
+        # Don't clobber a position the user set while the scan was running
+        pos = self.positions_cache.setdefault(img.path, pos)
+        self._index_position(img.path, pos)
+        self._index_time(img.path, taken)
+        # A position still being written keeps its COORDS_WRITING marker
+        if self.exif_writer is None or not self.exif_writer.is_pending(img.path):
+            img.coords_set = 'Y' if pos is not None else 'N'
+        if on_position_loaded is not None:
+            on_position_loaded(img)
+
+
+    def _cached_metadata(self, path):
+        """ Returns (position, capture time) of path from the persistent cache, or MISS """
+        if self.position_cache is None:
+            return PositionCache.MISS
+        try:
+            return self.position_cache.get_entry(path)
+        except sqlite3.Error:
+            print(f"Error reading position cache for {path}", sys.exc_info()[0])
+            return PositionCache.MISS
+
+
+    def _store_cached_position(self, path, pos):
+        if path not in self.capture_times:
+            # Storing a position without its capture time would make the
+            # cache report the file as not having one
+            return
+        self._store_cached_positions([(path, pos, self.capture_times[path])])
+
+
+    def _begin_cache_batch(self):
+        self._cache_writes = []
+        return self._cache_writes
+
+
+    def _end_cache_batch(self, batch):
+        self._store_cached_positions(batch)
+        batch.clear()
+        # A generator left half way may only finish after a newer batch started
+        if self._cache_writes is batch:
+            self._cache_writes = None
+
+
+    def _queue_cached_position(self, path, meta):
+        batch = self._cache_writes
+        if batch is None:
+            self._store_cached_positions([(path, *meta)])
+            return
+        batch.append((path, *meta))
+        if len(batch) >= ImgManager.POSITION_CACHE_BATCH:
+            self._store_cached_positions(batch)
+            batch.clear()
+
+
+    def _store_cached_positions(self, entries):
+        if self.position_cache is None or len(entries) == 0:
+            return
+        try:
+            self.position_cache.put_many(entries)
+        except sqlite3.Error:
+            print("Error updating position cache", sys.exc_info()[0])
 
 
     def get_image_preview(self, fname):
-        for img in self.imgs:
-            if img.fname == fname:
-                img.preview = self.build_preview(img.path)
-                return img.preview
+        img = self.imgs_by_fname.get(fname)
+        if img is not None:
+            preview = self.previews.get(img)
+            if preview is None:
+                preview = self.build_preview(img.path)
+                self.previews.put(img, preview)
+            return preview
 
         print(f"{fname} isn't a loaded file, this shouldn't happen (but I'm sure it will)")
         return self.preview_not_loaded
 
 
+    def load_preview(self, fname):
+        """ Like get_image_preview, but safe to call from a worker thread: no
+        wx.Bitmap is created. Returns a cached wx.Bitmap if there is one,
+        otherwise a wx.Image that must be handed to preview_to_bitmap from
+        the UI thread. """
+        img = self.imgs_by_fname.get(fname)
+        if img is None:
+            return self.preview_not_loaded
+        preview = self.previews.get(img)
+        if preview is not None:
+            return preview
+        preview = self.build_preview_image(img.path)
+        return preview if preview is not None else self.preview_not_loaded
+
+
+    def preview_to_bitmap(self, fname, preview):
+        """ Second half of load_preview, must run in the UI thread """
+        if isinstance(preview, wx.Bitmap):
+            return preview
+        bmp = wx.Bitmap(preview)
+        img = self.imgs_by_fname.get(fname)
+        if img is not None:
+            self.previews.put(img, bmp)
+        return bmp
+
+
+    def preview_cache_stats(self):
+        """ Returns hit/miss/eviction counters of the in memory preview cache """
+        return self.previews.stats()
+
+
     def get_full_path_for(self, fname):
-        for img in self.imgs:
-            if img.fname == fname:
-                return img.path
-        return None
+        img = self.imgs_by_fname.get(fname)
+        return img.path if img is not None else None
+
+
+    def get_row_for(self, fname):
+        return self.rows_by_fname.get(fname)
 
 
     def get_description_for(self, files):
@@ -79,53 +503,232 @@ class ImgManager:
         return f"{file_selection}\nFile position: {file_coord}"""
 
 
-    def set_positions_for(self, pos, paths):
+    def set_positions_for(self, pos, paths, on_written=None):
+        """ Tags every file in paths with pos. With a background writer this
+        returns right away, with the new position already reported for each
+        file (and Img.coords_set at COORDS_WRITING until it's on disk);
+        on_written(img, pos, ok, pending) is then called from a worker
+        thread as each file is written. """
         if pos is None:
             print("Cowardly refusing to set null coords, bailing out")
             return
 
+        self._on_written = on_written
+        if self.exif_writer is not None:
+            fullpaths = [fp for fp in (self.get_full_path_for(fn) for fn in paths) if fp is not None]
+            formatted = format_position(*pos)
+            for fullpath in fullpaths:
+                self.positions_cache[fullpath] = formatted
+                self._index_position(fullpath, formatted)
+                self.imgs_by_path[fullpath].coords_set = ImgManager.COORDS_WRITING
+            self.exif_writer.write_many(pos, fullpaths)
+            return
+
         for fn in paths:
             fullpath = self.get_full_path_for(fn)
-            if set_exif_position(fullpath, pos):
-                self.positions_cache[fullpath] = pos
-                print("Set", fn, "to position", pos)
+            if self._write_position(fullpath, pos):
+                self._on_position_written(fullpath, pos, True)
             else:
                 print("Failed setting", fn, "to position", pos)
 
 
+    def _on_position_written(self, fullpath, pos, ok):
+        img = self.imgs_by_path.get(fullpath)
+        if self.exif_writer is not None and self.exif_writer.is_pending(fullpath):
+            # Re-tagged since this write started. The cache already has the
+            # newest position, and it's the one the next write will store.
+            pass
+        elif ok:
+            self.positions_cache[fullpath] = format_position(*pos)
+            self._store_cached_position(fullpath, self.positions_cache[fullpath])
+            self._index_position(fullpath, self.positions_cache[fullpath])
+            if img is not None:
+                img.coords_set = 'Y'
+        elif img is not None:
+            # The position shown was never written, go back to what's on disk
+            self._forget_metadata(fullpath)
+            img.coords_set = self.has_coords(fullpath)
+
+        if ok:
+            print("Set", fullpath, "to position", pos)
+        else:
+            print("Failed setting", fullpath, "to position", pos)
+
+        on_written = self._on_written
+        if on_written is not None and img is not None:
+            on_written(img, pos, ok, self.pending_writes())
+
+
+    def flush_writes(self, timeout=None):
+        """ Starts any delayed write and waits for background writes to
+        finish. Returns False on timeout """
+        if self.exif_writer is None:
+            return True
+        return self.exif_writer.wait(timeout)
+
+
+    def pending_writes(self):
+        return self.exif_writer.pending_count() if self.exif_writer is not None else 0
+
+
     def get_position(self, path):
         if path not in self.positions_cache:
-            self.positions_cache[path] = get_exif_position(path)
+            meta = self._cached_metadata(path)
+            if meta is PositionCache.MISS:
+                meta = get_exif_metadata(path)
+                self._queue_cached_position(path, meta)
+            pos, taken = meta
+            self.positions_cache[path] = pos
+            self._index_position(path, pos)
+            self._index_time(path, taken)
         return self.positions_cache[path]
 
 
-    def ls(self, path):
-        lst = os.listdir(path)
-        lst.sort()
-        files = []
-        for filename in lst:
-            for ext in self._allowed_extensions:
-                if filename.upper().endswith(ext.upper()):
-                    files.append(os.path.join(path, filename))
-        return files
+    def _index_position(self, path, pos):
+        coords = parse_position(pos) if pos is not None else None
+        if coords is None:
+            self.spatial_index.remove(path)
+        else:
+            self.spatial_index.add(path, *coords)
+
+
+    def _index_time(self, path, taken):
+        self.capture_times[path] = taken
+        try:
+            t = parse_exif_time(taken) if taken is not None else None
+        except ValueError:
+            t = None
+        if t is None:
+            self.time_index.remove(path)
+        else:
+            self.time_index.add(path, t)
+
+
+    def get_capture_time(self, path):
+        """ Returns the capture time of path in seconds, or None if unknown """
+        return self.time_index.get(path)
+
+
+    def sort_by_time(self, enabled):
+        """ Lists images by capture time (images without one go last) or,
+        with enabled=False, by name """
+        self.time_sorted = enabled
+        self._sort_imgs()
+
+
+    def _sort_imgs(self):
+        if self.time_sorted:
+            order = {path: i for i, path in enumerate(self.time_index.sorted_keys())}
+            last = len(order)
+            self.imgs.sort(key=lambda img: (order.get(img.path, last), img.fname))
+        else:
+            self.imgs.sort(key=lambda img: img.fname)
+        self.rows_by_fname = {img.fname: row for row, img in enumerate(self.imgs)}
+
+
+    def images_taken_around(self, fname, window_s):
+        """ Returns the fnames of the images taken within window_s seconds
+        of fname (not including fname), in capture order """
+        path = self.get_full_path_for(fname)
+        if path is None:
+            return []
+        around = self.time_index.keys_around(path, window_s)
+        return [self.imgs_by_path[p].fname for p in around if p != path and p in self.imgs_by_path]
+
+
+    def propagate_position(self, fname, window_s, on_written=None, skip_tagged=True):
+        """ Tags the images taken within window_s seconds of fname with the
+        position of fname, in one batch. Images that already have a position
+        are left alone unless skip_tagged is False. Returns the fnames that
+        will be tagged. """
+        path = self.get_full_path_for(fname)
+        coords = parse_position(self.get_position(path)) if path is not None else None
+        if coords is None:
+            print(f"{fname} has no position, nothing to propagate")
+            return []
+
+        targets = self.images_taken_around(fname, window_s)
+        if skip_tagged:
+            tagged = ('Y', ImgManager.COORDS_WRITING)
+            targets = [fn for fn in targets if self.imgs_by_fname[fn].coords_set not in tagged]
+        if len(targets) > 0:
+            self.set_positions_for(coords, targets, on_written)
+        return targets
+
+
+    def images_near(self, coords, radius_m):
+        """ Returns the loaded images with a known position within radius_m
+        meters of coords, closest first """
+        if coords is None:
+            return []
+        found = self.spatial_index.query_radius(coords[0], coords[1], radius_m)
+        return [self.imgs_by_path[path] for _, path in found if path in self.imgs_by_path]
+
+
+    def images_in_bbox(self, lat_min, lon_min, lat_max, lon_max):
+        paths = self.spatial_index.query_bbox(lat_min, lon_min, lat_max, lon_max)
+        return [self.imgs_by_path[path] for path in paths if path in self.imgs_by_path]
 
 
     def has_coords(self, path):
         try:
             return 'Y' if self.get_position(path) is not None else 'N'
         except:
-            print(f"Error loading coords for {file_path}", sys.exc_info()[0])
+            print(f"Error loading coords for {path}", sys.exc_info()[0])
             return 'N'
 
 
+    def _build_placeholder(self, path):
+        """ Loads path as a preview without going through the preview
+        decoders or the thumbnail cache, this happens before the window is up """
+        with instrument.span('startup.placeholder'):
+            img = wx.Image(path)
+            if not img.IsOk():
+                print(f"Can't load placeholder preview {path}")
+                return wx.NullBitmap
+            return wx.Bitmap(img.Scale(*self.preview_size, wx.IMAGE_QUALITY_NORMAL))
+
+
     def build_preview(self, path):
+        preview = self.build_preview_image(path)
+        return wx.Bitmap(preview) if preview is not None else self.preview_not_loaded
+
+
+    def build_preview_image(self, path):
+        """ Returns the preview of path as a wx.Image, or None on error """
         try:
-            preview = wx.Image(path, wx.BITMAP_TYPE_ANY)
-            preview = preview.Scale(*self.preview_size, wx.IMAGE_QUALITY_NORMAL)
-            return wx.Bitmap(preview)
+            preview = self._cached_preview(path)
+            if preview is not None:
+                instrument.count('preview.disk_cache_hit')
+                return preview
+            with instrument.span('preview.decode'):
+                preview = decode_for_size(path, self.preview_size)
+                preview = preview.Scale(*self.preview_size, wx.IMAGE_QUALITY_NORMAL)
+            self._store_cached_preview(path, preview)
+            return preview
         except:
             print(f"Error creating preview for {path}", sys.exc_info()[0])
-            return self.preview_not_loaded
+            return None
 
 
+    def _cached_preview(self, path):
+        if self.thumbnail_cache is None:
+            return None
+        try:
+            data = self.thumbnail_cache.get(path, self.preview_size)
+        except sqlite3.Error:
+            print(f"Error reading thumbnail cache for {path}", sys.exc_info()[0])
+            return None
+        return decode_jpeg(data) if data is not None else None
+
 
+    def _store_cached_preview(self, path, preview):
+        if self.thumbnail_cache is None:
+            return
+        data = encode_jpeg(preview)
+        if data is None:
+            return
+        try:
+            self.thumbnail_cache.put(path, self.preview_size, data)
+        except sqlite3.Error:
+            print(f"Error updating thumbnail cache for {path}", sys.exc_info()[0])
@@ -0,0 +1,106 @@
+""" Listing of image files, without depending on any UI toolkit """
+
+from fnmatch import fnmatch
+import instrument
+import os
+
+ALLOWED_EXTENSIONS = ('JPG', 'JPEG')
+# RAW files aren't listed on their own (they can't be previewed), but they
+# are paired with the JPEG of the same name so both get the same position
+RAW_EXTENSIONS = ('ARW', 'CR2', 'CR3', 'DNG', 'NEF', 'ORF', 'PEF', 'RAF', 'RW2', 'SRW')
+
+
+class ScanEntry:
+    __slots__ = ('path', 'name', 'relpath', 'size', 'mtime_ns', 'companions', 'sidecar_mtime_ns')
+
+    def __init__(self, path, name, relpath, size, mtime_ns, companions=(), sidecar_mtime_ns=None):
+        self.path = path
+        self.name = name
+        # Path relative to the root of the scan, same as name unless recursive
+        self.relpath = relpath
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # Full paths of RAW files shot together with this one
+        self.companions = companions
+        # mtime of the XMP sidecar of path, None if it has none
+        self.sidecar_mtime_ns = sidecar_mtime_ns
+
+
+def _ext_set(extensions):
+    return frozenset('.' + ext.upper() for ext in extensions)
+
+
+def scan(root, recursive=False, extensions=ALLOWED_EXTENSIONS, exclude=()):
+    """ Yields a ScanEntry for every image in root, sorted by name within each
+    directory. Entries are produced as each directory is read, so consumers
+    can start working before a large tree has been walked. exclude is a list
+    of glob patterns; matching files and directories are skipped. """
+    exts = _ext_set(extensions)
+    raw_exts = _ext_set(RAW_EXTENSIONS)
+
+    def excluded(name):
+        return any(fnmatch(name, pat) for pat in exclude)
+
+    # (st_dev, st_ino) of every directory listed. Symlinked directories are
+    # followed, but a link to an ancestor (or to a dir seen through another
+    # link) would list the same files again, or forever.
+    visited = set()
+    pending = [(root, '')]
+    while pending:
+        dirpath, reldir = pending.pop()
+        try:
+            st = os.stat(dirpath)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            with instrument.span('scan.list_dir'), os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as ex:
+            print(f"Can't list {dirpath}: {ex}")
+            continue
+        instrument.count('scan.dir_entries', len(entries))
+
+        # Stem -> RAW files of that name in this directory
+        raws = {}
+        # Stem -> sidecar, named as xmp_sidecar.sidecar_path names them
+        sidecars = {}
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.upper() in raw_exts and not excluded(entry.name):
+                raws.setdefault(stem.upper(), []).append(entry.path)
+            elif ext == '.xmp':
+                sidecars[stem] = entry
+
+        subdirs = []
+        for entry in entries:
+            if excluded(entry.name):
+                continue
+            relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+            try:
+                if entry.is_dir():
+                    if recursive:
+                        subdirs.append((entry.path, relpath))
+                    continue
+                stem, ext = os.path.splitext(entry.name)
+                if ext.upper() not in exts:
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+            sidecar_mtime_ns = None
+            if stem in sidecars:
+                try:
+                    sidecar_mtime_ns = sidecars[stem].stat().st_mtime_ns
+                except OSError:
+                    pass
+            yield ScanEntry(entry.path, entry.name, relpath, st.st_size, st.st_mtime_ns,
+                            tuple(raws.get(stem.upper(), ())), sidecar_mtime_ns)
+
+        # Reversed so that the stack pops subdirectories in name order
+        pending.extend(reversed(subdirs))
+
+
+def iter_images(root, extensions=ALLOWED_EXTENSIONS, exclude=()):
+    """ Yields the full path of every image under root, recursively """
+    for entry in scan(root, recursive=True, extensions=extensions, exclude=exclude):
+        yield entry.path
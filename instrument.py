@@ -0,0 +1,159 @@
+""" Opt-in timing of hot paths. Disabled by default, and close to free when
+disabled. Enable with the environment variables
+
+    IMGEOTAGGER_PROFILE=stats.json    Aggregated spans/counters, written on exit
+    IMGEOTAGGER_CPROFILE=session.prof Run the whole session under cProfile
+
+or by calling configure() (eg from a command line flag). """
+
+from contextlib import contextmanager
+import atexit
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+_lock = threading.Lock()
+_enabled = False
+_out_path = None
+_profiler = None
+_profile_path = None
+_exit_hook_registered = False
+_stats = {}
+_counters = {}
+
+
+class _SpanStats:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        # Histogram in power of two buckets of milliseconds: bucket k holds
+        # durations in [2^(k-1), 2^k) ms, bucket 0 everything under 1 ms
+        self.buckets = {}
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        self.min = min(self.min, secs)
+        self.max = max(self.max, secs)
+        ms = secs * 1000
+        bucket = 0 if ms < 1 else int(math.log2(ms)) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0,
+            'min_ms': 1000 * self.min if self.count else 0,
+            'max_ms': 1000 * self.max,
+            'histogram_ms': {('<1' if k == 0 else f"<{2 ** k}"): n for k, n in sorted(self.buckets.items())},
+        }
+
+
+def enabled():
+    return _enabled
+
+
+def configure(out_path=None, cprofile_path=None):
+    """ Enables instrumentation. Stats are dumped to out_path on exit, and
+    if cprofile_path is set the rest of the session runs under cProfile. """
+    global _enabled, _out_path, _profiler, _profile_path, _exit_hook_registered
+    if out_path is not None:
+        _enabled = True
+        _out_path = out_path
+    if cprofile_path is not None and _profiler is None:
+        import cProfile
+        _profile_path = cprofile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if (out_path is not None or cprofile_path is not None) and not _exit_hook_registered:
+        _exit_hook_registered = True
+        atexit.register(_on_exit)
+
+
+def record(name, secs):
+    with _lock:
+        st = _stats.get(name)
+        if st is None:
+            st = _stats[name] = _SpanStats()
+        st.add(secs)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+@contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def span(name):
+    """ Context manager that times its body as one sample of name """
+    return _span(name) if _enabled else _NULL_SPAN
+
+
+def timed(name):
+    """ Decorator version of span """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return timed_fn
+    return wrap
+
+
+def snapshot():
+    with _lock:
+        return {
+            'spans': {name: st.to_dict() for name, st in sorted(_stats.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def dump(path):
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
+
+def _on_exit():
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        print(f"cProfile stats written to {_profile_path}")
+    if _enabled and _out_path is not None:
+        dump(_out_path)
+        print(f"Instrumentation stats written to {_out_path}")
+
+
+configure(os.environ.get('IMGEOTAGGER_PROFILE'), os.environ.get('IMGEOTAGGER_CPROFILE'))
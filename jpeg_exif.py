@@ -0,0 +1,203 @@
+""" Minimal reader for the EXIF block of a JPEG file. Only looks at the APP1
+segment at the start of the file, so it never has to read image data. """
+
+import struct
+
+SOI = b'\xff\xd8'
+APP1 = 0xE1
+SOS = 0xDA
+EXIF_HEADER = b'Exif\x00\x00'
+
+TAG_THUMBNAIL_OFFSET = 0x0201
+TAG_THUMBNAIL_LENGTH = 0x0202
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_GPS_IFD = 0x8825
+TAG_GPS_LAT_REF = 0x0001
+TAG_GPS_LAT = 0x0002
+TAG_GPS_LON_REF = 0x0003
+TAG_GPS_LON = 0x0004
+
+TYPE_ASCII = 2
+TYPE_RATIONAL = 5
+
+# Size of the fixed part of each TIFF type, indexed by type id
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+class UnsupportedExif(Exception):
+    """ The file has metadata this reader can't handle, use a full parser """
+
+
+def read_app1(f):
+    """ Returns the TIFF payload of the EXIF APP1 segment of an open JPEG
+    file, or None if the file has no EXIF block. Raises UnsupportedExif if
+    the file isn't a JPEG, or its segments can't be followed. """
+    if f.read(2) != SOI:
+        raise UnsupportedExif("Not a JPEG")
+
+    while True:
+        marker = f.read(4)
+        if len(marker) != 4 or marker[0] != 0xFF:
+            raise UnsupportedExif("Unexpected data in the JPEG headers")
+        kind = marker[1]
+        seg_len = struct.unpack('>H', marker[2:])[0]
+        if kind == SOS:
+            # Image data starts here, no more metadata segments: there's no EXIF
+            return None
+
+        if kind == APP1:
+            seg = f.read(seg_len - 2)
+            if seg.startswith(EXIF_HEADER):
+                return seg[len(EXIF_HEADER):]
+            # Could be an XMP APP1, there may be an EXIF one after it
+            continue
+
+        f.seek(seg_len - 2, 1)
+
+
+class TiffBlock:
+    """ Random access to the IFDs of a TIFF block, as embedded in EXIF """
+
+    def __init__(self, data):
+        if data[:2] == b'II':
+            self.endian = '<'
+        elif data[:2] == b'MM':
+            self.endian = '>'
+        else:
+            raise ValueError("Not a TIFF block")
+        self.data = data
+
+
+    def unpack(self, fmt, offset):
+        return struct.unpack_from(self.endian + fmt, self.data, offset)
+
+
+    def first_ifd_offset(self):
+        return self.unpack('I', 4)[0]
+
+
+    def read_ifd(self, offset):
+        """ Returns ({tag: (type, count, value_offset)}, next_ifd_offset) """
+        count = self.unpack('H', offset)[0]
+        entries = {}
+        for i in range(count):
+            entry_pos = offset + 2 + i * 12
+            tag, typ, cnt = self.unpack('HHI', entry_pos)
+            size = _TYPE_SIZES.get(typ, 1) * cnt
+            # Values of up to 4 bytes are stored inline in the entry
+            value_pos = entry_pos + 8 if size <= 4 else self.unpack('I', entry_pos + 8)[0]
+            entries[tag] = (typ, cnt, value_pos)
+        next_ifd = self.unpack('I', offset + 2 + count * 12)[0]
+        return entries, next_ifd
+
+
+    def read_int(self, entry):
+        typ, _, pos = entry
+        if typ == 3:
+            return self.unpack('H', pos)[0]
+        if typ == 4:
+            return self.unpack('I', pos)[0]
+        raise ValueError(f"Unexpected TIFF type {typ} for an integer")
+
+
+    def read_ascii(self, entry):
+        typ, cnt, pos = entry
+        if typ != TYPE_ASCII:
+            raise ValueError(f"Unexpected TIFF type {typ} for a string")
+        return self.data[pos:pos + cnt].split(b'\x00', 1)[0].decode('ascii', 'replace')
+
+
+    def read_rationals(self, entry):
+        typ, cnt, pos = entry
+        if typ != TYPE_RATIONAL:
+            raise ValueError(f"Unexpected TIFF type {typ} for a rational")
+        vals = []
+        for i in range(cnt):
+            num, den = self.unpack('II', pos + 8 * i)
+            # Same as img_exif.frac_to_sex: some cameras write 0/0
+            vals.append(num / (den if den != 0 else 1))
+        return vals
+
+
+def read_exif_thumbnail(path):
+    """ Returns the bytes of the JPEG thumbnail stored in IFD1 of path, or
+    None if there isn't one (or the file isn't a JPEG) """
+    try:
+        with open(path, 'rb') as f:
+            data = read_app1(f)
+        if data is None:
+            return None
+
+        tiff = TiffBlock(data)
+        _, ifd1 = tiff.read_ifd(tiff.first_ifd_offset())
+        if ifd1 == 0:
+            return None
+        entries, _ = tiff.read_ifd(ifd1)
+        if TAG_THUMBNAIL_OFFSET not in entries or TAG_THUMBNAIL_LENGTH not in entries:
+            return None
+
+        start = tiff.read_int(entries[TAG_THUMBNAIL_OFFSET])
+        end = start + tiff.read_int(entries[TAG_THUMBNAIL_LENGTH])
+        thumb = data[start:end]
+        if end > len(data) or not thumb.startswith(SOI):
+            return None
+        return thumb
+    except (OSError, ValueError, struct.error, UnsupportedExif):
+        return None
+
+
+def read_gps(path):
+    """ Reads the GPS position of a JPEG by parsing only its EXIF block.
+    Returns None if the file has no position, or a tuple
+    ((degs, mins, secs), lat_ref, (degs, mins, secs), lon_ref). Raises
+    UnsupportedExif if the file can't be handled here. """
+    return read_gps_and_time(path)[0]
+
+
+def read_gps_and_time(path):
+    """ Same as read_gps, but also returns the DateTimeOriginal string of
+    the file (or None), as (gps, datetime). Both come from the same block,
+    so the second costs almost nothing once the first is read. """
+    try:
+        with open(path, 'rb') as f:
+            data = read_app1(f)
+    except OSError as ex:
+        raise UnsupportedExif(str(ex))
+    if data is None:
+        # A JPEG without EXIF, there's nothing a full parser would find either
+        return None, None
+
+    try:
+        tiff = TiffBlock(data)
+        ifd0, _ = tiff.read_ifd(tiff.first_ifd_offset())
+        return _read_gps_ifd(tiff, ifd0), _read_datetime_original(tiff, ifd0)
+    except (ValueError, struct.error) as ex:
+        raise UnsupportedExif(str(ex))
+
+
+def _read_gps_ifd(tiff, ifd0):
+    if TAG_GPS_IFD not in ifd0:
+        return None
+    gps, _ = tiff.read_ifd(tiff.read_int(ifd0[TAG_GPS_IFD]))
+    if any(tag not in gps for tag in (TAG_GPS_LAT, TAG_GPS_LON, TAG_GPS_LAT_REF, TAG_GPS_LON_REF)):
+        return None
+    lat = tiff.read_rationals(gps[TAG_GPS_LAT])
+    lon = tiff.read_rationals(gps[TAG_GPS_LON])
+    if len(lat) != 3 or len(lon) != 3:
+        raise UnsupportedExif("Unexpected GPS coordinate format")
+    return (tuple(lat), tiff.read_ascii(gps[TAG_GPS_LAT_REF]),
+            tuple(lon), tiff.read_ascii(gps[TAG_GPS_LON_REF]))
+
+
+def _read_datetime_original(tiff, ifd0):
+    # A broken timestamp shouldn't hide a valid position, treat it as missing
+    try:
+        if TAG_EXIF_IFD not in ifd0:
+            return None
+        exif, _ = tiff.read_ifd(tiff.read_int(ifd0[TAG_EXIF_IFD]))
+        if TAG_DATETIME_ORIGINAL not in exif:
+            return None
+        return tiff.read_ascii(exif[TAG_DATETIME_ORIGINAL]).strip() or None
+    except (ValueError, struct.error):
+        return None
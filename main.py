@@ -1,23 +1,80 @@
+import time
+# Taken before any other import, so that startup times include them
+START_TIME = time.monotonic()
+
 from img_browser import ImgBrowser
 from img_manager import ImgManager
+from full_preview import FullPreviewLoader
 from geo_browser import GeoBrowser
+from position_cache import PositionCache
+from thumbnail_cache import ThumbnailCache
+import argparse
+import instrument
+import os
+import sys
 import wx
 
 
 class Main(wx.App):
     IMG_PREVIEW_SIZE = (120,67)
-
-    def __init__(self, redirect):
+    # Number of workers reading EXIF positions when a directory is opened
+    SCAN_WORKERS = os.cpu_count() or 4
+    # Disk budget for previews kept between sessions
+    THUMBNAIL_CACHE_BYTES = 256 * 1024 * 1024
+    # Memory budget for preview bitmaps of the current directory
+    PREVIEW_CACHE_BYTES = 64 * 1024 * 1024
+    # Number of files tagged in parallel. Writes are mostly IO bound.
+    WRITE_WORKERS = 4
+    # A file is written once it hasn't been re-tagged for this long, so
+    # re-aiming a position a few times only writes the last one
+    WRITE_DELAY_SECS = 2
+    # How long to wait for pending tags to be written on exit
+    EXIT_FLUSH_TIMEOUT_SECS = 60
+    # Only create rows and previews for the visible part of the image list
+    VIRTUAL_IMG_LIST = True
+    # Number of threads decoding list previews
+    PREVIEW_WORKERS = 3
+    # Large previews: decoding threads, and number of decoded images kept
+    FULL_PREVIEW_WORKERS = 2
+    FULL_PREVIEW_CACHE_SIZE = 6
+    # Show the window first and start CEF and the map once it's painted, so
+    # the image list can be used while the map loads
+    LAZY_MAP = True
+
+    def __init__(self, redirect, mbtiles_path=None, sidecars=False):
+        """ With sidecars, positions are written to XMP sidecar files instead
+        of to the images themselves """
+        self.mbtiles_path = mbtiles_path
         super().__init__(redirect=redirect)
 
         self.frame = wx.Frame(parent=None, id=wx.ID_ANY,
                           title='IMGeotagger V3, xplat edition', size=(800, 600))
 
-        self.browser = GeoBrowser(self.frame)
-        self.img_manager = ImgManager(Main.IMG_PREVIEW_SIZE)
-        self.img_browser = ImgBrowser(self, self.frame, Main.IMG_PREVIEW_SIZE)
+        self.browser = GeoBrowser(self.frame, mbtiles_path=self.mbtiles_path)
+        try:
+            position_cache = PositionCache()
+        except Exception:
+            print("Can't open position cache, positions will be read from every file", sys.exc_info()[0])
+            position_cache = None
+        try:
+            thumbnail_cache = ThumbnailCache(max_bytes=Main.THUMBNAIL_CACHE_BYTES)
+        except Exception:
+            print("Can't open thumbnail cache, previews will be rebuilt every time", sys.exc_info()[0])
+            thumbnail_cache = None
+        self.img_manager = ImgManager(Main.IMG_PREVIEW_SIZE, scan_workers=Main.SCAN_WORKERS,
+                                      position_cache=position_cache,
+                                      thumbnail_cache=thumbnail_cache,
+                                      write_workers=Main.WRITE_WORKERS,
+                                      write_delay=Main.WRITE_DELAY_SECS,
+                                      sidecars=sidecars,
+                                      preview_cache_bytes=Main.PREVIEW_CACHE_BYTES)
+        self.img_browser = ImgBrowser(self, self.frame, Main.IMG_PREVIEW_SIZE, virtual=Main.VIRTUAL_IMG_LIST,
+                                      preview_workers=Main.PREVIEW_WORKERS)
 
         self.preview_active = False
+        self.preview_wanted = None
+        self.full_previews = FullPreviewLoader(workers=Main.FULL_PREVIEW_WORKERS,
+                                               cache_size=Main.FULL_PREVIEW_CACHE_SIZE)
         self.preview = wx.StaticBitmap(self.frame, id=wx.ID_ANY, bitmap=wx.NullBitmap)
         self.preview.SetScaleMode(wx.StaticBitmap.Scale_AspectFill)
         self.preview.Hide()
@@ -28,69 +85,152 @@ class Main(wx.App):
         self.box.Add(self.preview, 1, wx.EXPAND)
         self.frame.SetSizer(self.box)
 
-        self.browser.load_browser()
+        if not Main.LAZY_MAP:
+            self.browser.load_browser()
 
+        # The first idle event comes once everything pending, including the
+        # first paint of the window, has been processed
+        self.frame.Bind(wx.EVT_IDLE, self._on_first_idle)
         self.SetTopWindow(self.frame)
         self.frame.Show()
 
-        self.coords = None
-        self.timer_id = 1
-        self.timer = wx.Timer(self, self.timer_id)
-        self.Bind(wx.EVT_TIMER, self.on_timer, self.timer)
-        self.timer.Start(300)
+        self.browser.set_coords_listener(self.on_map_moved)
+
 
+    def _on_first_idle(self, evt):
+        evt.Skip()
+        self.frame.Unbind(wx.EVT_IDLE, handler=self._on_first_idle)
+        first_paint = time.monotonic() - START_TIME
+        instrument.record('startup.first_paint', first_paint)
+        print(f"Time to first paint: {1000 * first_paint:.0f} ms")
+        if Main.LAZY_MAP:
+            self.browser.load_browser()
+            instrument.record('startup.map_started', time.monotonic() - START_TIME)
 
-    def on_preview_requested(self, fname):
+
+    def on_preview_requested(self, fname, neighbors=()):
+        """ Toggles the large preview of fname. neighbors are the images the
+        user is likely to preview next, they are decoded in the background. """
         if self.preview_active:
             pos = self.preview.GetPosition()
             size = self.preview.GetSize()
+            self.preview_wanted = None
             self.preview.SetBitmap(wx.NullBitmap)
             self.preview.Hide()
             self.browser.panel.SetPosition(pos)
             self.browser.panel.SetSize(size)
             self.browser.panel.Show()
         else:
-            path = self.img_manager.get_full_path_for(fname)
             pos = self.browser.panel.GetPosition()
             size = self.browser.panel.GetSize()
-            img = wx.Image(path , wx.BITMAP_TYPE_ANY).ConvertToBitmap()
-            self.preview.SetBitmap(img)
             self.browser.panel.Hide()
             self.preview.SetPosition(pos)
             self.preview.SetSize(size)
             self.preview.Show()
+            self.show_preview(fname, neighbors)
 
         self.preview_active = not self.preview_active
         self.frame.Update()
 
-    
+
+    def show_preview(self, fname, neighbors=()):
+        """ Replaces the image in the (already visible) large preview """
+        path = self.img_manager.get_full_path_for(fname)
+        if path is None:
+            return
+        size = self.preview.GetSize().Get()
+        self.preview_wanted = path
+        self.full_previews.request(path, size, self._on_full_preview_ready)
+        neighbor_paths = [self.img_manager.get_full_path_for(fn) for fn in neighbors]
+        self.full_previews.prefetch([p for p in neighbor_paths if p is not None], size)
+
+
+    def _on_full_preview_ready(self, path, img):
+        if path != self.preview_wanted:
+            # User moved on to another image while this one was decoding
+            return
+        self.preview.SetBitmap(wx.Bitmap(img))
+        self.frame.Update()
+
+
     def get_description_for(self, paths):
         return self.img_manager.get_description_for(paths)
 
 
-    def load_images_from(self, path):
-        self.img_manager.reload(path)
+    def iter_images_from(self, path, on_position_loaded=None, recursive=False, on_scan_done=None):
+        return self.img_manager.iter_reload(path, on_position_loaded, recursive, on_scan_done)
+
+
+    def get_images_near(self, coords, radius_m):
+        return self.img_manager.images_near(coords, radius_m)
+
+
+    def sort_images_by_time(self, enabled):
+        self.img_manager.sort_by_time(enabled)
+
+
+    def images_sorted_by_time(self):
+        return self.img_manager.time_sorted
+
+
+    def get_loaded_images(self):
         return self.img_manager.imgs
 
+
+    def start_watching(self, on_changes):
+        self.img_manager.start_watching(on_changes)
+
+
+    def stop_watching(self):
+        self.img_manager.stop_watching()
+
+
+    def apply_dir_changes(self, changes):
+        self.img_manager.apply_changes(changes)
+
     
-    def get_image_preview(self, fname):
-        return self.img_manager.get_image_preview(fname)
+    def load_preview(self, fname):
+        return self.img_manager.load_preview(fname)
+
+
+    def preview_to_bitmap(self, fname, preview):
+        return self.img_manager.preview_to_bitmap(fname, preview)
+
+
+    def get_placeholder_preview(self):
+        return self.img_manager.preview_not_loaded
+
+
+    def get_row_for(self, fname):
+        return self.img_manager.get_row_for(fname)
 
     
-    def set_gps_coords_for(self, paths):
+    def set_gps_coords_for(self, paths, on_written=None):
         pos = self.browser.get_coords()
-        self.img_manager.set_positions_for(pos, paths)
+        self.img_manager.set_positions_for(pos, paths, on_written)
+
+
+    def get_pending_writes(self):
+        return self.img_manager.pending_writes()
+
+
+    def propagate_position_from(self, fname, window_s, on_written=None):
+        return self.img_manager.propagate_position(fname, window_s, on_written)
 
 
-    def on_timer(self, _):
-        new_coords = self.browser.get_coords()
-        if self.coords != new_coords:
-            self.coords = new_coords
-            self.img_browser.map_moved_to(self.browser.get_coords())
+    def on_map_moved(self, coords):
+        self.img_browser.map_moved_to(coords)
 
 
     def OnExit(self):
-        self.timer.Stop()
+        self.img_manager.stop_watching()
+        self.full_previews.shutdown()
+        pending = self.img_manager.pending_writes()
+        if pending > 0:
+            print(f"Writing {pending} pending positions before exiting")
+        if not self.img_manager.flush_writes(Main.EXIT_FLUSH_TIMEOUT_SECS):
+            print(f"Warning: exiting with {self.img_manager.pending_writes()} positions still pending to be written")
+        print("Preview cache stats:", self.img_manager.preview_cache_stats())
         self.browser.on_app_exit()
         del self.browser
         GeoBrowser.static_on_app_exit()
@@ -98,6 +238,14 @@ class Main(wx.App):
 
 
 if __name__ == '__main__':
-    app = Main(False)
+    parser = argparse.ArgumentParser(description="IMGeotagger V3")
+    parser.add_argument('--mbtiles', help="Use this MBTiles file as an offline map instead of Google Maps")
+    parser.add_argument('--sidecar', action='store_true',
+                        help="Write positions to XMP sidecars (IMG_0001.xmp) instead of rewriting the images")
+    parser.add_argument('--profile', help="Record timings of hot paths and write them as JSON to this file on exit")
+    parser.add_argument('--cprofile', help="Run the session under cProfile and write its stats to this file")
+    args = parser.parse_args()
+    instrument.configure(args.profile, args.cprofile)
+    app = Main(False, mbtiles_path=args.mbtiles, sidecars=args.sidecar)
     app.MainLoop()
 
@@ -0,0 +1,59 @@
+""" Read access to MBTiles files: map tiles stored in a SQLite database, see
+https://github.com/mapbox/mbtiles-spec """
+
+import sqlite3
+import threading
+
+_MIME_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+class MBTiles:
+    def __init__(self, path):
+        self.path = path
+        # Tiles are requested from CEF's IO thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.metadata = dict(self._db.execute('SELECT name, value FROM metadata').fetchall())
+
+
+    @property
+    def mime_type(self):
+        return _MIME_TYPES.get(self.metadata.get('format', 'png').lower(), 'application/octet-stream')
+
+
+    def zoom_range(self):
+        try:
+            return int(self.metadata['minzoom']), int(self.metadata['maxzoom'])
+        except (KeyError, ValueError):
+            with self._lock:
+                return self._db.execute('SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles').fetchone()
+
+
+    def center(self):
+        """ Returns (lat, lon, zoom) of the default view, or None """
+        try:
+            lon, lat, zoom = self.metadata['center'].split(',')
+            return float(lat), float(lon), int(zoom)
+        except (KeyError, ValueError):
+            return None
+
+
+    def get_tile(self, z, x, y):
+        """ Returns the tile at z/x/y (XYZ, as used by web maps), or None """
+        # MBTiles uses the TMS scheme, with y counting from the bottom
+        tms_y = (1 << z) - 1 - y
+        with self._lock:
+            row = self._db.execute('SELECT tile_data FROM tiles'
+                                   ' WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                                   (z, x, tms_y)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,128 @@
+""" Offline map backend: a local map page whose tiles come from an MBTiles
+file. Every request of the page is answered by a CEF resource handler, so
+panning never touches the network. """
+
+from mbtiles import MBTiles
+import json
+import os
+
+# Origin of the local page. Never resolved, all requests to it are served from Python.
+LOCAL_ORIGIN = 'http://imgeotagger.local/'
+MAP_URL = LOCAL_ORIGIN + 'map.html'
+
+_ASSETS_DIR = os.path.dirname(os.path.abspath(__file__))
+_ASSETS = {
+    'map.html': ('offline_map.html', 'text/html'),
+    'crosshair.png': ('crosshair.png', 'image/png'),
+}
+
+
+class _BytesResourceHandler(object):
+    """ Serves a response that is already in memory. on_done(handler) is
+    called once the response has been read or the request cancelled. """
+
+    def __init__(self, data, mime_type, status=200, on_done=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.status = status
+        self.offset = 0
+        self.on_done = on_done
+
+    def _done(self):
+        on_done, self.on_done = self.on_done, None
+        if on_done is not None:
+            on_done(self)
+
+    def ProcessRequest(self, request, callback):
+        callback.Continue()
+        return True
+
+    def GetResponseHeaders(self, response, response_length_out, redirect_url_out):
+        response.SetStatus(self.status)
+        response.SetMimeType(self.mime_type)
+        response_length_out[0] = len(self.data)
+
+    def ReadResponse(self, data_out, bytes_to_read, bytes_read_out, callback):
+        if self.offset >= len(self.data):
+            bytes_read_out[0] = 0
+            self._done()
+            return False
+        chunk = self.data[self.offset:self.offset + bytes_to_read]
+        self.offset += len(chunk)
+        data_out[0] = chunk
+        bytes_read_out[0] = len(chunk)
+        return True
+
+    def CanGetCookie(self, cookie):
+        return False
+
+    def CanSetCookie(self, cookie):
+        return False
+
+    def Cancel(self):
+        self._done()
+
+
+class OfflineMapRequestHandler(object):
+    """ CEF request handler that serves the local map page, its assets and
+    its tiles. Requests to any other origin are refused, so that a page
+    trying to reach the network fails fast instead of waiting on it. """
+
+    def __init__(self, mbtiles_path):
+        self.tiles = MBTiles(mbtiles_path)
+        self._assets = {}
+        # cefpython only keeps weak references to resource handlers, they
+        # must be kept alive here until CEF is done with them
+        self._handlers = {}
+
+
+    def _serve(self, data, mime_type, status=200):
+        handler = _BytesResourceHandler(data, mime_type, status, self._release)
+        self._handlers[id(handler)] = handler
+        return handler
+
+
+    def _release(self, handler):
+        self._handlers.pop(id(handler), None)
+
+
+    def _not_found(self):
+        return self._serve(b'', 'text/plain', status=404)
+
+
+    def _asset(self, name):
+        if name not in self._assets:
+            fname, mime_type = _ASSETS[name]
+            with open(os.path.join(_ASSETS_DIR, fname), 'rb') as f:
+                self._assets[name] = (f.read(), mime_type)
+        return self._assets[name]
+
+
+    def _metadata(self):
+        minzoom, maxzoom = self.tiles.zoom_range()
+        center = self.tiles.center()
+        meta = {'minzoom': minzoom, 'maxzoom': maxzoom,
+                'center': list(center) if center is not None else None}
+        return json.dumps(meta).encode('utf-8')
+
+
+    def GetResourceHandler(self, browser, frame, request, **_):
+        url = request.GetUrl()
+        if not url.startswith(LOCAL_ORIGIN):
+            return self._not_found()
+
+        path = url[len(LOCAL_ORIGIN):].split('?', 1)[0]
+        if path in _ASSETS:
+            return self._serve(*self._asset(path))
+        if path == 'metadata.json':
+            return self._serve(self._metadata(), 'application/json')
+        if path.startswith('tiles/'):
+            try:
+                z, x, y = [int(v) for v in path[len('tiles/'):].split('/')]
+            except ValueError:
+                return self._not_found()
+            tile = self.tiles.get_tile(z, x, y)
+            if tile is None:
+                return self._not_found()
+            return self._serve(tile, self.tiles.mime_type)
+        return self._not_found()
@@ -0,0 +1,104 @@
+from xmp_sidecar import sidecar_path
+import os
+import sqlite3
+import sys
+import threading
+
+
+def user_cache_dir():
+    """ Per-user directory where IMGeotagger may keep caches between runs """
+    if sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    elif sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'imgeotagger')
+
+
+class PositionCache:
+    """ Persistent store of the position and capture time read from each
+    file. An entry is only valid while the file keeps the same size and
+    mtime, so an edit by any other tool invalidates it. """
+
+    # Returned by get() when the file has no valid entry. None can't be used
+    # for that, since "this file has no position" is also worth caching.
+    MISS = object()
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(user_cache_dir(), 'positions.sqlite')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        # The same cache is used from the UI thread and from the scanner
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        cols = [row[1] for row in self._db.execute('PRAGMA table_info(positions)')]
+        if len(cols) > 0 and 'capture_time' not in cols:
+            # Cache from an older version, without capture times. Entries
+            # can't be told apart from files without one, so start over.
+            self._db.execute('DROP TABLE positions')
+        self._db.execute('CREATE TABLE IF NOT EXISTS positions ('
+                         ' path TEXT PRIMARY KEY,'
+                         ' size INTEGER NOT NULL,'
+                         ' mtime_ns INTEGER NOT NULL,'
+                         ' position TEXT,'
+                         ' capture_time TEXT)')
+        self._db.commit()
+
+
+    @staticmethod
+    def _file_key(path):
+        st = os.stat(path)
+        mtime_ns = st.st_mtime_ns
+        try:
+            # A sidecar overrides the position in the file, so creating or
+            # editing one must invalidate the entry as well
+            mtime_ns += os.stat(sidecar_path(path)).st_mtime_ns
+        except OSError:
+            pass
+        return st.st_size, mtime_ns
+
+
+    def get(self, path):
+        entry = self.get_entry(path)
+        return entry if entry is PositionCache.MISS else entry[0]
+
+
+    def get_entry(self, path):
+        """ Returns (position, capture_time) of path, or MISS """
+        try:
+            size, mtime_ns = PositionCache._file_key(path)
+        except OSError:
+            return PositionCache.MISS
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, position, capture_time FROM positions WHERE path = ?',
+                                   (path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return PositionCache.MISS
+        return row[2], row[3]
+
+
+    def put(self, path, position, capture_time=None):
+        self.put_many([(path, position, capture_time)])
+
+
+    def put_many(self, entries):
+        """ entries is a list of (path, position, capture_time) """
+        rows = []
+        for path, position, capture_time in entries:
+            try:
+                size, mtime_ns = PositionCache._file_key(path)
+            except OSError:
+                continue
+            rows.append((path, size, mtime_ns, position, capture_time))
+
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,147 @@
+""" Background loading of list previews. Rows are loaded by a pool of
+workers, visible rows first, then rows close to the visible ones, then the
+rest. Results are handed back to the UI thread in batches. """
+
+import heapq
+import sys
+import threading
+
+
+class PreviewLoader:
+    VISIBLE = 0
+    NEARBY = 1
+    REST = 2
+
+    def __init__(self, load, on_loaded, post, workers=2, max_batch=32):
+        """ load(row) runs in a worker and returns the preview for row (or
+        None). on_loaded([(row, preview)...]) gets batches of results and is
+        always invoked through post, eg wx.CallAfter, so it runs in the UI
+        thread. At most max_batch results are delivered at once. """
+        self._load = load
+        self._on_loaded = on_loaded
+        self._post = post
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._generation = 0
+        self._pending = set()
+        self._inflight = set()
+        self._heap = []
+        self._viewport = (0, -1, 0)
+        self._drop_far = False
+        self._results = []
+        self._stopped = False
+        self._workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for w in self._workers:
+            w.start()
+
+
+    def reset(self):
+        """ Drops every queued row. Loads in progress are discarded when they
+        finish, so this never blocks. """
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            self._inflight.clear()
+            self._heap = []
+            self._results = []
+
+
+    def _priority(self, row):
+        first, last, margin = self._viewport
+        if first <= row <= last:
+            return (PreviewLoader.VISIBLE, row - first, row)
+        dist = first - row if row < first else row - last
+        if dist <= margin:
+            return (PreviewLoader.NEARBY, dist, row)
+        return (PreviewLoader.REST, dist, row)
+
+
+    def request(self, rows):
+        with self._lock:
+            added = False
+            for row in rows:
+                if row in self._pending or row in self._inflight:
+                    continue
+                prio = self._priority(row)
+                if self._drop_far and prio[0] == PreviewLoader.REST:
+                    continue
+                self._pending.add(row)
+                heapq.heappush(self._heap, prio)
+                added = True
+            if added:
+                self._work.notify_all()
+
+
+    def set_viewport(self, first, last, margin, drop_far=False):
+        """ Reorders the queue for rows [first, last] being visible. With
+        drop_far, queued rows further than margin from them are discarded. """
+        with self._lock:
+            if self._viewport == (first, last, margin) and self._drop_far == drop_far:
+                return
+            self._viewport = (first, last, margin)
+            self._drop_far = drop_far
+            heap = [self._priority(row) for row in self._pending]
+            if drop_far:
+                heap = [p for p in heap if p[0] != PreviewLoader.REST]
+                self._pending = set(p[2] for p in heap)
+            heapq.heapify(heap)
+            self._heap = heap
+
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending) + len(self._inflight)
+
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            self._pending.clear()
+            self._heap = []
+            self._work.notify_all()
+
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                self._work.wait_for(lambda: self._stopped or len(self._heap) > 0)
+                if self._stopped:
+                    return
+                _, _, row = heapq.heappop(self._heap)
+                if row not in self._pending:
+                    continue
+                self._pending.discard(row)
+                self._inflight.add(row)
+                generation = self._generation
+
+            try:
+                preview = self._load(row)
+            except:
+                print(f"Error loading preview for row {row}", sys.exc_info()[0])
+                preview = None
+
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                # Only the first result of a batch schedules a flush, the
+                # rest piggyback on it
+                schedule = len(self._results) == 0
+                self._results.append((row, preview))
+            if schedule:
+                self._post(self._flush, generation)
+
+
+    def _flush(self, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            batch = self._results[:self.max_batch]
+            self._results = self._results[self.max_batch:]
+            for row, _ in batch:
+                self._inflight.discard(row)
+            more = len(self._results) > 0
+
+        if more:
+            self._post(self._flush, generation)
+        self._on_loaded([(row, preview) for row, preview in batch if preview is not None])
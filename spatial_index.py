@@ -0,0 +1,106 @@
+""" Index of positions for fast "what's near here" queries. Positions are
+bucketed in a grid of fixed size cells, so a query only looks at the few
+cells that overlap the area of interest. """
+
+import math
+import threading
+
+EARTH_RADIUS_M = 6371000
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """ Distance in meters between two points """
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    def __init__(self, cell_deg=0.01):
+        """ cell_deg is the side of each cell, in degrees. The default is
+        roughly 1 km, which fits queries of a few hundred meters to a few km. """
+        self.cell_deg = cell_deg
+        self._lock = threading.Lock()
+        # (cell_x, cell_y) -> {key: (lat, lon)}
+        self._cells = {}
+        # key -> cell
+        self._cell_of = {}
+
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lon / self.cell_deg)), int(math.floor(lat / self.cell_deg)))
+
+
+    def __len__(self):
+        return len(self._cell_of)
+
+
+    def add(self, key, lat, lon):
+        """ Adds key at (lat, lon), replacing any previous position of key """
+        cell = self._cell(lat, lon)
+        with self._lock:
+            self._remove(key)
+            self._cells.setdefault(cell, {})[key] = (lat, lon)
+            self._cell_of[key] = cell
+
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+
+    def _remove(self, key):
+        cell = self._cell_of.pop(key, None)
+        if cell is None:
+            return
+        entries = self._cells[cell]
+        del entries[key]
+        if len(entries) == 0:
+            del self._cells[cell]
+
+
+    def clear(self):
+        with self._lock:
+            self._cells = {}
+            self._cell_of = {}
+
+
+    def _candidates(self, lat_min, lon_min, lat_max, lon_max):
+        # Called with the lock held. Yields (key, lat, lon) in cells overlapping the box.
+        x0, y0 = self._cell(lat_min, lon_min)
+        x1, y1 = self._cell(lat_max, lon_max)
+        n_cells = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if n_cells > len(self._cells):
+            # Big area, cheaper to go through the occupied cells only
+            cells = [c for c in self._cells if x0 <= c[0] <= x1 and y0 <= c[1] <= y1]
+        else:
+            cells = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in self._cells]
+        for cell in cells:
+            for key, (lat, lon) in self._cells[cell].items():
+                yield key, lat, lon
+
+
+    def query_bbox(self, lat_min, lon_min, lat_max, lon_max):
+        """ Returns the keys of every position inside the box. Boxes crossing
+        the antimeridian aren't supported. """
+        with self._lock:
+            return [key for key, lat, lon in self._candidates(lat_min, lon_min, lat_max, lon_max)
+                    if lat_min <= lat <= lat_max and lon_min <= lon <= lon_max]
+
+
+    def query_radius(self, lat, lon, radius_m):
+        """ Returns [(distance_m, key)] of every position within radius_m of
+        (lat, lon), closest first """
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        coslat = max(math.cos(math.radians(lat)), 1e-6)
+        dlon = min(180.0, dlat / coslat)
+        found = []
+        with self._lock:
+            for key, klat, klon in self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+                dist = haversine_m(lat, lon, klat, klon)
+                if dist <= radius_m:
+                    found.append((dist, key))
+        found.sort()
+        return found
@@ -0,0 +1,138 @@
+from position_cache import user_cache_dir
+import os
+import sqlite3
+import threading
+import time
+
+
+class ThumbnailCache:
+    """ Persistent store of encoded preview images. An entry is keyed by the
+    file path and the preview size, and is only valid while the file keeps
+    the same size and mtime. The total size of all stored previews is kept
+    under max_bytes by evicting the least recently used ones. """
+
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+    # Hits only record their time in memory. They're written with the next
+    # put, or once this many have piled up, in a single transaction.
+    TOUCH_BATCH = 256
+
+    def __init__(self, db_path=None, max_bytes=DEFAULT_MAX_BYTES):
+        if db_path is None:
+            db_path = os.path.join(user_cache_dir(), 'thumbnails.sqlite')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        # Previews are loaded in the background, the cache may be used from any thread
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # Losing the last few writes on a power cut only costs rebuilding
+        # some previews, no need to sync the disk on every commit
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS thumbnails ('
+                         ' path TEXT NOT NULL,'
+                         ' width INTEGER NOT NULL,'
+                         ' height INTEGER NOT NULL,'
+                         ' size INTEGER NOT NULL,'
+                         ' mtime_ns INTEGER NOT NULL,'
+                         ' last_used REAL NOT NULL,'
+                         ' data BLOB NOT NULL,'
+                         ' PRIMARY KEY (path, width, height))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS thumbnails_lru ON thumbnails (last_used)')
+        self._db.commit()
+        self._total_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(LENGTH(data)), 0) FROM thumbnails').fetchone()[0]
+        # (path, width, height) -> last time it was read, not written to the db yet
+        self._touched = {}
+
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+
+    def get(self, path, preview_size):
+        """ Returns the stored preview of path, or None if there is no valid one """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        key = (path, preview_size[0], preview_size[1])
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, data FROM thumbnails'
+                                   ' WHERE path = ? AND width = ? AND height = ?', key).fetchone()
+            if row is None:
+                return None
+            if row[0] != st.st_size or row[1] != st.st_mtime_ns:
+                self._delete(key, len(row[2]))
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= ThumbnailCache.TOUCH_BATCH:
+                self._flush_touched()
+                self._db.commit()
+            return row[2]
+
+
+    def put(self, path, preview_size, data):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if len(data) > self.max_bytes:
+            return
+
+        key = (path, preview_size[0], preview_size[1])
+        with self._lock:
+            old = self._db.execute('SELECT LENGTH(data) FROM thumbnails'
+                                   ' WHERE path = ? AND width = ? AND height = ?', key).fetchone()
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._touched.pop(key, None)
+            self._db.execute('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             key + (st.st_size, st.st_mtime_ns, time.time(), data))
+            self._total_bytes += len(data)
+            # Evict by up to date use times
+            self._flush_touched()
+            self._evict()
+            self._db.commit()
+
+
+    def _flush_touched(self):
+        # Called with the lock held, the caller commits
+        if len(self._touched) == 0:
+            return
+        self._db.executemany('UPDATE thumbnails SET last_used = ?'
+                             ' WHERE path = ? AND width = ? AND height = ?',
+                             [(t,) + key for key, t in self._touched.items()])
+        self._touched = {}
+
+
+    def _delete(self, key, nbytes):
+        self._touched.pop(key, None)
+        self._db.execute('DELETE FROM thumbnails WHERE path = ? AND width = ? AND height = ?', key)
+        self._db.commit()
+        self._total_bytes -= nbytes
+
+
+    def _evict(self):
+        # Called with the lock held
+        while self._total_bytes > self.max_bytes:
+            victims = self._db.execute('SELECT path, width, height, LENGTH(data) FROM thumbnails'
+                                       ' ORDER BY last_used LIMIT 64').fetchall()
+            if len(victims) == 0:
+                self._total_bytes = 0
+                return
+            for path, width, height, nbytes in victims:
+                if self._total_bytes <= self.max_bytes:
+                    return
+                self._db.execute('DELETE FROM thumbnails WHERE path = ? AND width = ? AND height = ?',
+                                 (path, width, height))
+                self._total_bytes -= nbytes
+
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._db.commit()
+            self._db.close()
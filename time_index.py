@@ -0,0 +1,80 @@
+""" Index of capture times, for "what was shot around the same time"
+queries. Times are kept as a sorted array, so a time window is found with
+two binary searches. """
+
+from array import array
+from bisect import bisect_left, bisect_right
+import threading
+
+
+class TimeIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> time, the source of truth
+        self._time_of = {}
+        # Sorted views of _time_of, rebuilt lazily after changes. Sorting once
+        # is much cheaper than inserting in order while a folder is scanned.
+        self._times = array('d')
+        self._keys = []
+        self._dirty = False
+
+
+    def __len__(self):
+        return len(self._time_of)
+
+
+    def add(self, key, t):
+        """ Adds key at time t (in seconds), replacing any previous time of key """
+        with self._lock:
+            self._time_of[key] = t
+            self._dirty = True
+
+
+    def remove(self, key):
+        with self._lock:
+            if self._time_of.pop(key, None) is not None:
+                self._dirty = True
+
+
+    def clear(self):
+        with self._lock:
+            self._time_of = {}
+            self._times = array('d')
+            self._keys = []
+            self._dirty = False
+
+
+    def get(self, key):
+        return self._time_of.get(key)
+
+
+    def _sorted(self):
+        # Caller must hold the lock
+        if self._dirty:
+            entries = sorted((t, key) for key, t in self._time_of.items())
+            self._times = array('d', (t for t, _ in entries))
+            self._keys = [key for _, key in entries]
+            self._dirty = False
+        return self._times, self._keys
+
+
+    def keys_between(self, t_from, t_to):
+        """ Returns the keys with a time in [t_from, t_to], oldest first """
+        with self._lock:
+            times, keys = self._sorted()
+            return keys[bisect_left(times, t_from):bisect_right(times, t_to)]
+
+
+    def keys_around(self, key, window_s):
+        """ Returns the keys within window_s seconds of key (including key
+        itself), or an empty list if key has no known time """
+        t = self._time_of.get(key)
+        if t is None:
+            return []
+        return self.keys_between(t - window_s, t + window_s)
+
+
+    def sorted_keys(self):
+        """ Returns every key, oldest first """
+        with self._lock:
+            return list(self._sorted()[1])
@@ -0,0 +1,138 @@
+""" Reading and writing GPS positions in XMP sidecar files. A sidecar is a
+small XML file next to an image (IMG_0001.xmp for IMG_0001.JPG and
+IMG_0001.CR2, as Adobe tools name them), so tagging doesn't need to rewrite
+the image itself, and one sidecar covers a RAW+JPEG pair. """
+
+import os
+import xml.etree.ElementTree as ET
+
+NS_X = 'adobe:ns:meta/'
+NS_RDF = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
+NS_EXIF = 'http://ns.adobe.com/exif/1.0/'
+
+GPS_LAT = f'{{{NS_EXIF}}}GPSLatitude'
+GPS_LON = f'{{{NS_EXIF}}}GPSLongitude'
+GPS_VERSION = f'{{{NS_EXIF}}}GPSVersionID'
+DESCRIPTION = f'{{{NS_RDF}}}Description'
+
+_EMPTY_XMP = (f'<x:xmpmeta xmlns:x="{NS_X}">'
+              f'<rdf:RDF xmlns:rdf="{NS_RDF}">'
+              f'<rdf:Description rdf:about="" xmlns:exif="{NS_EXIF}"/>'
+              '</rdf:RDF></x:xmpmeta>')
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + '.xmp'
+
+
+def parse_gps_coordinate(txt):
+    """ Parses an XMP GPSCoordinate ('DDD,MM,SSk' or 'DDD,MM.mmk') to
+    (decimal degrees, ref). Raises ValueError if txt isn't one. """
+    txt = txt.strip()
+    ref = txt[-1:].upper()
+    if ref not in ('N', 'S', 'E', 'W'):
+        raise ValueError(f"Invalid GPS coordinate {txt}")
+    parts = [float(p) for p in txt[:-1].split(',')]
+    if len(parts) == 2:
+        return parts[0] + parts[1] / 60., ref
+    if len(parts) == 3:
+        return parts[0] + parts[1] / 60. + parts[2] / 3600., ref
+    raise ValueError(f"Invalid GPS coordinate {txt}")
+
+
+def format_gps_coordinate(dec, refs):
+    """ Formats a signed decimal as an XMP GPSCoordinate. refs is the
+    (positive, negative) pair of references, eg ('N', 'S') """
+    ref = refs[1] if dec < 0 else refs[0]
+    dec = abs(dec)
+    degs = int(dec)
+    return f"{degs},{(dec - degs) * 60:.6f}{ref}"
+
+
+def _gps_values(desc):
+    """ Returns the (lat, lon) strings of an rdf:Description. XMP allows
+    them as attributes or as child elements. """
+    vals = []
+    for key in (GPS_LAT, GPS_LON):
+        val = desc.get(key)
+        if val is None:
+            child = desc.find(key)
+            val = child.text if child is not None else None
+        vals.append(val)
+    return vals
+
+
+def read_gps(path):
+    """ Returns (lat, lat_ref, lon, lon_ref), with lat and lon as unsigned
+    decimals, from the sidecar of path. Returns None if there's no sidecar,
+    or it has no valid position. """
+    try:
+        root = ET.parse(sidecar_path(path)).getroot()
+    except FileNotFoundError:
+        return None
+    except (OSError, ET.ParseError) as ex:
+        print(f"Error reading sidecar of {path}: {ex}")
+        return None
+
+    for desc in root.iter(DESCRIPTION):
+        lat, lon = _gps_values(desc)
+        if lat is None or lon is None:
+            continue
+        try:
+            return (*parse_gps_coordinate(lat), *parse_gps_coordinate(lon))
+        except ValueError:
+            print(f"Invalid position in sidecar of {path}")
+            return None
+    return None
+
+
+def write_gps(path, coords):
+    """ Sets the position of path in its sidecar, creating the sidecar if
+    needed. Anything else already in the sidecar is kept. Returns True on
+    success. """
+    xmp_path = sidecar_path(path)
+    try:
+        # Keep the prefixes of the existing file, ElementTree would
+        # otherwise rename them to ns0, ns1...
+        for _, (prefix, uri) in ET.iterparse(xmp_path, events=('start-ns',)):
+            if prefix:
+                ET.register_namespace(prefix, uri)
+        tree = ET.parse(xmp_path)
+    except FileNotFoundError:
+        tree = ET.ElementTree(ET.fromstring(_EMPTY_XMP))
+    except (OSError, ET.ParseError) as ex:
+        print(f"Error reading sidecar of {path}, not overwriting it: {ex}")
+        return False
+    for prefix, uri in (('x', NS_X), ('rdf', NS_RDF), ('exif', NS_EXIF)):
+        ET.register_namespace(prefix, uri)
+
+    root = tree.getroot()
+    descs = list(root.iter(DESCRIPTION))
+    if len(descs) == 0:
+        rdf = root if root.tag == f'{{{NS_RDF}}}RDF' else root.find(f'{{{NS_RDF}}}RDF')
+        if rdf is None:
+            print(f"Sidecar of {path} isn't valid XMP, not overwriting it")
+            return False
+        descs = [ET.SubElement(rdf, DESCRIPTION, {f'{{{NS_RDF}}}about': ''})]
+
+    # Drop any previous position, wherever it was, then set it in the first description
+    for desc in descs:
+        for key in (GPS_LAT, GPS_LON):
+            desc.attrib.pop(key, None)
+            for child in desc.findall(key):
+                desc.remove(child)
+
+    lat, lon = coords
+    descs[0].set(GPS_VERSION, '2.2.0.0')
+    descs[0].set(GPS_LAT, format_gps_coordinate(lat, ('N', 'S')))
+    descs[0].set(GPS_LON, format_gps_coordinate(lon, ('E', 'W')))
+
+    # Write to a temp file first, a partial sidecar would lose the user's edits
+    tmp_path = xmp_path + '.tmp'
+    try:
+        tree.write(tmp_path, encoding='utf-8', xml_declaration=False)
+        os.replace(tmp_path, xmp_path)
+    except OSError as ex:
+        print(f"Error writing sidecar of {path}: {ex}")
+        return False
+    return True